@@ -0,0 +1,109 @@
+"""
+Input encoding and batched evaluation for the move-prediction network.
+
+Training (C4_train_ANN.py) and inference (C4_engine.py) both go through keys_to_bits, so they see bit-identical inputs:
+    - Key:
+        current_pos + mask, a unique number for each board state
+    - Network input:
+        the lower 7 bytes of the little-endian key, each byte unpacked from its most significant bit. 56 values of 0 or 1
+
+Two inference backends are available through load_model:
+    - 'keras': the saved keras model. Imports tensorflow
+    - 'numpy': a NumPy forward pass over weights exported with export_weights. No tensorflow, loads in milliseconds
+
+Usage: python C4_ANN.py keras_model_file weights_file.npz (exports the weights of a keras model)
+"""
+
+import sys
+import numpy as np
+from C4_batch import canonical_keys
+
+n_possible_moves = 7
+n_input_bits = 56
+predict_batch_size = 4096 #positions per model call when scoring large arrays
+
+
+def keys_to_bits(keys):
+    """ returns an Nx56 uint8 array of network inputs for an array of N keys """
+    keys = np.asarray(keys, dtype='<u8').reshape(-1)
+    #change each key from a 64-bit int to 8 8-bit ints, then remove the last byte, because we only use 56 bits
+    key_bytes = keys.view(np.uint8).reshape(len(keys), 8)[:, :-1]
+    #change the 7 8-bit numbers to 56 values of '0' or '1'
+    return np.unpackbits(key_bytes, axis=1)
+
+def position_keys(current_pos, mask):
+    """ returns the keys of arrays of positions """
+    return np.asarray(current_pos, dtype=np.uint64) + np.asarray(mask, dtype=np.uint64)
+
+def predict_keys(model, keys, batch_size=predict_batch_size, canonical=False):
+    """
+    returns an Nx7 array of move probabilities for an array of N keys, in one batched call of the model
+    canonical: for models trained on canonical keys only. Mirrored positions are evaluated as their canonical key,
+    and their probabilities are mapped back through the mirror (column c <-> 6 - c)
+    """
+    if not canonical:
+        return model.predict(keys_to_bits(keys), batch_size=batch_size)
+    keys, mirrored = canonical_keys(keys)
+    predictions = model.predict(keys_to_bits(keys), batch_size=batch_size)
+    predictions[mirrored] = predictions[mirrored, ::-1]
+    return predictions
+
+def predict_positions(model, current_pos, mask, batch_size=predict_batch_size, canonical=False):
+    """ returns an Nx7 array of move probabilities for arrays of N current_pos and mask bitboards """
+    return predict_keys(model, position_keys(current_pos, mask), batch_size, canonical)
+
+
+activations = {
+    'tanh': np.tanh,
+    'relu': lambda x: np.maximum(x, 0),
+    'linear': lambda x: x,
+}
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+activations['softmax'] = softmax
+
+
+def export_weights(model_file, weights_file):
+    """ saves the kernels, biases and activations of a keras model of Dense layers (56-30-20-10-7) to a .npz file """
+    from tensorflow import keras
+    model = keras.models.load_model(model_file)
+    arrays = {}
+    layer_activations = []
+    for i, layer in enumerate(model.layers):
+        kernel, bias = layer.get_weights()
+        arrays['kernel%d' % i] = kernel.astype(np.float32)
+        arrays['bias%d' % i] = bias.astype(np.float32)
+        layer_activations.append(layer.activation.__name__)
+    np.savez(weights_file, activations=np.array(layer_activations), **arrays)
+
+class numpy_model:
+    """ forward pass of the dense network in NumPy float32. predict() has the same interface as the keras model """
+    def __init__(self, weights_file):
+        weights = np.load(weights_file)
+        self.activations = [str(name) for name in weights['activations']]
+        self.kernels = [weights['kernel%d' % i] for i in range(len(self.activations))]
+        self.biases = [weights['bias%d' % i] for i in range(len(self.activations))]
+
+    def predict(self, x, batch_size=None):
+        x = np.asarray(x, dtype=np.float32)
+        for kernel, bias, activation in zip(self.kernels, self.biases, self.activations):
+            x = activations[activation](x @ kernel + bias)
+        return x
+
+def load_model(model_file, backend='keras'):
+    """ returns a model with a keras-like predict(), for backend 'keras' or 'numpy' """
+    if backend == 'numpy':
+        return numpy_model(model_file)
+    if backend == 'keras':
+        from tensorflow import keras #imported here, so the numpy backend never pays for tensorflow
+        return keras.models.load_model(model_file)
+    raise ValueError("unknown backend '%s', expected 'keras' or 'numpy'" % backend)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print(__doc__)
+        sys.exit(1)
+    export_weights(sys.argv[1], sys.argv[2])
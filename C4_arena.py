@@ -0,0 +1,265 @@
+"""
+Headless matches between two players, played on many processes at once.
+
+A player is any object with
+    - choose_move(state): returns the column to play in a C4_state (a copy, the player may change it)
+    - new_game(seed): called before every game, with a seed derived from the match seed
+Built in players: 'random' (uniform legal moves), 'ann' (the engine's AI_move) and 'solver' (perfect play from solver.solve).
+
+Every opening position is played twice, once with each player to move, so neither player profits from a good opening.
+Openings are random positions drawn from a seed, or positions of an opening book with a given number of moves.
+The report gives wins, draws and losses of the first player with 95% Wilson confidence intervals,
+and the percentiles of the time each player took per move.
+
+Usage examples:
+    python C4_arena.py ann random --games 1000 --opening-moves 4
+    python C4_arena.py ann=model.npz ann --games 2000 --json results.json
+    python C4_arena.py ann solver --book book8 --opening-moves 8 --games 200
+    python C4_arena.py ann=project_ANN2 random --backend keras (a saved keras model, needs tensorflow)
+
+Perfect play from early positions takes long to compute. Give the solver a book (--player-book) or use deeper openings
+"""
+
+import sys
+import json
+import math
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import solver
+import C4_book
+import C4_engine
+from C4_position import C4_state, alignment, width
+from C4_batch import C4_batch_state, key_positions
+
+latency_percentiles = (50, 90, 99)
+
+
+class random_player:
+    """ plays a uniformly random legal move """
+    def __init__(self):
+        self.rng = np.random.default_rng()
+
+    def new_game(self, seed):
+        self.rng = np.random.default_rng(seed)
+
+    def choose_move(self, state):
+        return int(self.rng.choice([move for move in range(width) if state.can_play(move)]))
+
+class ANN_player:
+    """ the engine's move: book move, immediate win, then the network's best move that doesn't lose at once """
+    def __init__(self, model_file=None, backend='numpy', book_name=None, canonical=False, time_ms=None):
+        self.engine = C4_engine.engine(book_name, backend, model_file, canonical, timed=time_ms is not None)
+        self.time_ms = time_ms #with a time budget, moves are searched (engine.timed_move)
+        if time_ms is None: #load the model and compile the move picking now, so it isn't counted as the time of the first move
+            self.engine.warm_up(timed=False)
+
+    def new_game(self, seed):
+        pass
+
+    def choose_move(self, state):
+        self.engine.game_state = state
+        return self.engine.choose_move(self.time_ms)
+
+class solver_player:
+    """ perfect play: a move with the best score. ties go to the most central column. the table is kept from move to move """
+    def __init__(self, table_size=16777259, book_name=None):
+        book = C4_book.opening_book(book_name) if book_name else None
+        self.solver = solver.solver(table_size, book=book)
+
+    def new_game(self, seed):
+        pass
+
+    def choose_move(self, state):
+        scores = self.solver.solve(state.current_pos, state.mask, state.n_moves)
+        return solver.best_move(scores)
+
+player_kinds = {'random': random_player, 'ann': ANN_player, 'solver': solver_player}
+
+
+def parse_player(spec, player_book=None, time_ms=None, backend='numpy'):
+    """ 'kind' or 'ann=model_file' -> (kind, keyword arguments), which is what the worker processes build players from """
+    kind, _, model_file = spec.partition('=')
+    if kind not in player_kinds:
+        raise ValueError("unknown player '%s', expected one of %s" % (kind, sorted(player_kinds)))
+    kwargs = {}
+    if model_file:
+        if kind != 'ann':
+            raise ValueError("only 'ann' players take a model file, got '%s'" % spec)
+        kwargs['model_file'] = model_file
+    if player_book and kind != 'random':
+        kwargs['book_name'] = player_book
+    if time_ms is not None and kind == 'ann':
+        kwargs['time_ms'] = time_ms
+    if kind == 'ann':
+        kwargs['backend'] = backend
+    return kind, kwargs
+
+def make_player(player_spec):
+    kind, kwargs = player_spec
+    return player_kinds[kind](**kwargs)
+
+def random_openings(n_openings, n_moves, seed):
+    """ returns n_openings (current_pos, mask, n_moves) positions of n_moves random moves, where the game is not over """
+    boards = C4_batch_state(n_openings)
+    boards.random_boards(n_moves, np.random.default_rng(seed))
+    return [(int(boards.current_pos[i]), int(boards.mask[i]), n_moves) for i in range(n_openings)]
+
+def book_openings(book_name, n_moves, n_openings=None, seed=0):
+    """ returns book positions with n_moves moves played: all of them, or a random sample of n_openings """
+    current_pos, mask, book_moves = key_positions(C4_book.opening_book(book_name).keys)
+    index = np.nonzero(book_moves == n_moves)[0]
+    if len(index) == 0:
+        raise ValueError("book %s has no positions with %d moves" % (book_name, n_moves))
+    if n_openings is not None and n_openings < len(index):
+        index = np.sort(np.random.default_rng(seed).choice(index, n_openings, replace=False))
+    return [(int(current_pos[i]), int(mask[i]), n_moves) for i in index]
+
+
+def play_game(players, opening, first, seed):
+    """
+    plays one game from an opening (current_pos, mask, n_moves). players[first] is the player to move.
+    An illegal move loses the game. returns (winner: 0, 1 or -1 for a draw, [move times of player 0, move times of player 1])
+    """
+    state = C4_state(*opening)
+    for i, player in enumerate(players):
+        player.new_game([seed, i]) #players of the same kind don't share their random draws
+    latencies = ([], [])
+    turn = first
+    while True:
+        start = time.perf_counter()
+        move = players[turn].choose_move(C4_state(state.current_pos, state.mask, state.n_moves))
+        latencies[turn].append(time.perf_counter() - start)
+        if not (0 <= move < width and state.can_play(move)):
+            return 1 - turn, latencies
+        state.play(move)
+        if alignment(state.current_pos ^ state.mask):
+            return turn, latencies
+        if state.check_draw():
+            return -1, latencies
+        turn = 1 - turn
+
+#players of a worker process, built once by init_worker since models and tables can't be sent between processes
+worker_players = None
+
+def init_worker(player_specs):
+    global worker_players
+    worker_players = [make_player(spec) for spec in player_specs]
+
+def play_task(task):
+    game_index, opening, first, seed = task
+    winner, latencies = play_game(worker_players, opening, first, seed)
+    return game_index, first, winner, latencies
+
+
+def wilson_interval(successes, n, z=1.96):
+    """ confidence interval of a rate successes / n. better than the normal approximation for rates close to 0 or 1 """
+    if n == 0:
+        return 0.0, 1.0
+    p = successes / n
+    denominator = 1 + z * z / n
+    center = (p + z * z / (2 * n)) / denominator
+    half_width = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+    return max(0.0, center - half_width), min(1.0, center + half_width)
+
+def latency_summary(latencies):
+    """ percentiles and mean of move times, in milliseconds """
+    if len(latencies) == 0:
+        return {'moves': 0}
+    ms = 1000 * np.asarray(latencies)
+    summary = {'moves': len(ms), 'mean_ms': float(ms.mean()), 'max_ms': float(ms.max())}
+    for percentile in latency_percentiles:
+        summary['p%d_ms' % percentile] = float(np.percentile(ms, percentile))
+    return summary
+
+def match_report(player_names, results):
+    """ W/D/L of player 0 with confidence intervals, overall and by who moved first in the opening, and move latencies """
+    winners = np.array([winner for game_index, first, winner, latencies in results])
+    firsts = np.array([first for game_index, first, winner, latencies in results])
+    report = {'players': list(player_names), 'games': len(results)}
+    for label, games in (('all', slice(None)), ('player0_to_move', firsts == 0), ('player1_to_move', firsts == 1)):
+        game_winners = winners[games]
+        n = len(game_winners)
+        counts = {'wins': int(np.count_nonzero(game_winners == 0)), 'draws': int(np.count_nonzero(game_winners == -1)),
+                  'losses': int(np.count_nonzero(game_winners == 1))}
+        record = {'games': n}
+        for outcome, count in counts.items():
+            record[outcome] = count
+            record[outcome + '_rate'] = count / n if n else 0.0
+            record[outcome + '_ci95'] = wilson_interval(count, n)
+        record['score'] = (counts['wins'] + counts['draws'] / 2) / n if n else 0.0
+        report[label] = record
+    report['latency'] = {player_names[i]: latency_summary([t for result in results for t in result[3][i]]) for i in range(2)}
+    return report
+
+def run_match(player_specs, openings, n_workers=None, seed=0, verbose=True):
+    """
+    plays every opening twice (each player to move once) on n_workers processes (default: one per cpu, 1: in this process).
+    returns the results, sorted by game: (game index, player to move in the opening, winner, move times)
+    """
+    tasks = [(2 * i + first, opening, first, seed + 2 * i + first) for i, opening in enumerate(openings) for first in (0, 1)]
+    if n_workers == 1:
+        init_worker(player_specs)
+        results = [play_task(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(n_workers, initializer=init_worker, initargs=(player_specs,)) as pool:
+            results = []
+            for result in pool.imap_unordered(play_task, tasks, chunksize=max(1, len(tasks) // (8 * (n_workers or multiprocessing.cpu_count())))):
+                results.append(result)
+                if verbose and len(results) % 100 == 0:
+                    print("played %d / %d games" % (len(results), len(tasks)))
+    return sorted(results, key=lambda result: result[0])
+
+def print_report(report):
+    name0, name1 = report['players']
+    print("%s vs %s, %d games" % (name0, name1, report['games']))
+    for label in ('all', 'player0_to_move', 'player1_to_move'):
+        record = report[label]
+        print("  %-16s" % label + "  ".join("%s %d (%.3f, ci %.3f-%.3f)" % (
+            outcome, record[outcome], record[outcome + '_rate'], *record[outcome + '_ci95']) for outcome in ('wins', 'draws', 'losses'))
+            + "  score %.3f" % record['score'])
+    for name, summary in report['latency'].items():
+        if summary['moves']:
+            print("  %-16s %d moves, mean %.2f ms, " % (name, summary['moves'], summary['mean_ms'])
+                  + ", ".join("p%d %.2f ms" % (percentile, summary['p%d_ms' % percentile]) for percentile in latency_percentiles)
+                  + ", max %.2f ms" % summary['max_ms'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Play matches between Connect Four players")
+    parser.add_argument('player0', help="random, solver, ann or ann=model_file (.npz weights, or a keras model with --backend keras)")
+    parser.add_argument('player1')
+    parser.add_argument('--games', type=int, default=1000, help="number of games, rounded up to an even number")
+    parser.add_argument('--opening-moves', type=int, default=4, help="moves played in every opening")
+    parser.add_argument('--book', help="draw the openings from this opening book instead of random moves")
+    parser.add_argument('--player-book', help="opening book used by the ann and solver players")
+    parser.add_argument('--backend', default='numpy', help="backend of the ann players: numpy (.npz weights) or keras")
+    parser.add_argument('--time-ms', type=float, help="time budget per move of the ann players, which then search their moves")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: one per cpu)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="write the report to this file")
+    args = parser.parse_args(argv)
+
+    player_specs = [parse_player(args.player0, args.player_book, args.time_ms, args.backend),
+                    parse_player(args.player1, args.player_book, args.time_ms, args.backend)]
+    n_openings = (args.games + 1) // 2
+    if args.book:
+        openings = book_openings(args.book, args.opening_moves, n_openings, args.seed)
+    else:
+        openings = random_openings(n_openings, args.opening_moves, args.seed)
+
+    start = time.perf_counter()
+    results = run_match(player_specs, openings, args.workers, args.seed)
+    report = match_report([args.player0, args.player1 if args.player1 != args.player0 else args.player1 + "(2)"], results)
+    report['seconds'] = time.perf_counter() - start
+    print_report(report)
+    print("%.1f s" % report['seconds'])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
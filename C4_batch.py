@@ -0,0 +1,152 @@
+"""
+Vectorized simulator for many games at once.
+
+Holds N games as uint64 NumPy arrays of 'current_pos' and 'mask' bitboards (same encoding as C4_position),
+and applies play, can_play, possible, alignment and can_win_next to all of them in one NumPy operation.
+Used to generate random boards and self-play positions in bulk, without a Python loop per game.
+"""
+
+import numpy as np
+from C4_position import height, width, all_bottom, board_mask
+
+#uint64 constants, so NumPy never mixes the bitboards with signed ints and silently casts them to float
+u_all_bottom = np.uint64(all_bottom)
+u_board_mask = np.uint64(board_mask)
+u_shift = [np.uint64(i) for i in range((height + 1) * width)]
+u_bottom_masks = np.array([1 << ((height + 1) * col) for col in range(width)], dtype=np.uint64)
+u_top_masks = np.array([1 << ((height + 1) * col + height - 1) for col in range(width)], dtype=np.uint64)
+u_zero = np.uint64(0)
+
+
+def alignment(pos):
+    """ returns a boolean array, True where 4 stones align in the bitmasks 'pos' """
+    result = np.zeros(pos.shape, dtype=bool)
+    for direction in (height + 1, height, height + 2, 1): #horizontal, diagonal 1, diagonal 2, vertical
+        m = pos & (pos >> u_shift[direction])
+        result |= (m & (m >> u_shift[2 * direction])) != u_zero
+    return result
+
+def winning_positions(pos, mask):
+    """ returns bitmasks with all the free spots that would make an alignment for the stones in 'pos' """
+    r = (pos << u_shift[1]) & (pos << u_shift[2]) & (pos << u_shift[3]) #vertical
+    for direction in (height + 1, height, height + 2): #horizontal, diagonal 1, diagonal 2
+        p = (pos << u_shift[direction]) & (pos << u_shift[2 * direction])
+        r |= p & (pos << u_shift[3 * direction])
+        r |= p & (pos >> u_shift[direction])
+        p = (pos >> u_shift[direction]) & (pos >> u_shift[2 * direction])
+        r |= p & (pos << u_shift[direction])
+        r |= p & (pos >> u_shift[3 * direction])
+    return r & (u_board_mask ^ mask)
+
+def mirror(bitboards):
+    """ returns the left-right mirror images of bitboards (pos, mask or keys) """
+    column_mask = np.uint64((1 << (height + 1)) - 1)
+    mirrored = np.zeros_like(bitboards)
+    for col in range(width):
+        mirrored |= ((bitboards >> u_shift[(height + 1) * col]) & column_mask) << u_shift[(height + 1) * (width - 1 - col)]
+    return mirrored
+
+def canonical_keys(keys):
+    """ returns (canonical keys, mirrored): the smaller of each key and its mirror image, and True where that is the mirror image """
+    keys = np.asarray(keys, dtype=np.uint64)
+    mirrored_keys = mirror(keys)
+    mirrored = mirrored_keys < keys
+    return np.where(mirrored, mirrored_keys, keys), mirrored
+
+def canonical_moves(moves, mirrored):
+    """ maps moves to (or back from) the canonical orientation: column c of a mirrored position is column 6 - c """
+    moves = np.asarray(moves)
+    return np.where(mirrored, width - 1 - moves, moves).astype(moves.dtype)
+
+def key_positions(keys):
+    """
+    returns (current_pos, mask, n_moves) for an array of keys (current_pos + mask).
+    A column with h stones has mask bits 2^h - 1, so its part of the key is in [2^h - 1, 2^(h+1) - 2], and h is found from the key alone
+    """
+    keys = np.asarray(keys, dtype=np.uint64)
+    column_mask = np.uint64((1 << (height + 1)) - 1)
+    mask = np.zeros_like(keys)
+    n_moves = np.zeros(keys.shape, dtype=np.int64)
+    for col in range(width):
+        column = ((keys >> u_shift[(height + 1) * col]) & column_mask) + np.uint64(1)
+        for stone in range(1, height + 1):
+            has_stone = column >= np.uint64(1 << stone) #the column holds at least 'stone' stones
+            mask |= has_stone.astype(np.uint64) << u_shift[(height + 1) * col + stone - 1]
+            n_moves += has_stone
+    return keys - mask, mask, n_moves
+
+def possible(mask):
+    """ returns bitmasks with all possible moves this turn """
+    return (mask + u_all_bottom) & u_board_mask
+
+def can_win_next(pos, mask):
+    """ returns bitmasks with the winning spots that are possible to play """
+    return winning_positions(pos, mask) & possible(mask)
+
+
+class C4_batch_state:
+    """
+    N games advanced together. Every method works on all games, or on the games selected by 'lanes'
+    (an index array or boolean mask), like a NumPy fancy index
+    """
+    def __init__(self, n_games):
+        self.current_pos = np.zeros(n_games, dtype=np.uint64) #bitmaps with '1' where there are current player stones
+        self.mask = np.zeros(n_games, dtype=np.uint64)        #bitmaps with '1' anywhere there is a stone
+        self.n_moves = np.zeros(n_games, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.mask)
+
+    def reset(self, lanes=slice(None)):
+        self.current_pos[lanes] = 0
+        self.mask[lanes] = 0
+        self.n_moves[lanes] = 0
+
+    def play(self, moves, lanes=slice(None)):
+        """ moves: 0-based column to play in each selected game """
+        mask = self.mask[lanes]
+        self.current_pos[lanes] ^= mask #switch current player with opponent
+        self.mask[lanes] = mask | (mask + u_bottom_masks[moves])
+        self.n_moves[lanes] += 1
+
+    def can_play(self, moves, lanes=slice(None)):
+        """ returns True where the column can be played """
+        return (self.mask[lanes] & u_top_masks[moves]) == u_zero
+
+    def legal_moves(self, lanes=slice(None)):
+        """ returns an Nx7 boolean array, True for every column that can be played """
+        return (self.mask[lanes][:, None] & u_top_masks[None, :]) == u_zero
+
+    def possible(self, lanes=slice(None)):
+        return possible(self.mask[lanes])
+
+    def keys(self, lanes=slice(None)):
+        return self.current_pos[lanes] + self.mask[lanes]
+
+    def last_move_aligned(self, lanes=slice(None)):
+        """ returns True where the player who just moved made an alignment """
+        return alignment(self.current_pos[lanes] ^ self.mask[lanes])
+
+    def can_win_next(self, lanes=slice(None)):
+        return can_win_next(self.current_pos[lanes], self.mask[lanes])
+
+    def play_random(self, rng, lanes=slice(None)):
+        """ plays a uniformly random legal move in each selected game. games must not be full """
+        scores = rng.random((len(self.mask[lanes]), width))
+        scores[~self.legal_moves(lanes)] = -1.0
+        self.play(np.argmax(scores, axis=1), lanes)
+
+    def random_boards(self, n_moves, rng=None):
+        """
+        Fills every game with n_moves random moves where neither player has made an alignment.
+        Games that make an alignment are reset and redrawn, without touching the games that are still going
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+        self.reset()
+        active = np.nonzero(self.n_moves < n_moves)[0]
+        while len(active):
+            self.play_random(rng, active)
+            failed = active[self.last_move_aligned(active)]
+            self.reset(failed)
+            active = np.nonzero(self.n_moves < n_moves)[0]
@@ -0,0 +1,125 @@
+"""
+Opening book: the exact score and best move of every position reachable in the first 'depth' moves.
+
+A book is saved as three .npy arrays side by side, which are memory-mapped when the book is opened:
+    - <book_name>.keys.npy: uint64 keys (current_pos + mask), sorted so lookups are a binary search
+    - <book_name>.vals.npy: int8 score of the position for the player to move
+    - <book_name>.moves.npy: uint8 best move (column)
+Mirrored positions share one entry. Only the smaller of key and mirror(key) is stored,
+and the move is stored for that orientation, so it is mirrored back (6 - move) when the other orientation is looked up.
+
+Usage: python C4_book.py book_name depth
+"""
+
+import sys
+import numpy as np
+import solver
+from C4_position import C4_state, alignment, mirror, width, top_masks
+
+
+def canonical_position(current_pos, mask):
+    """ returns (current_pos, mask, mirrored) for the orientation with the smaller key """
+    mirrored_pos = mirror(current_pos)
+    mirrored_mask = mirror(mask)
+    if mirrored_pos + mirrored_mask < current_pos + mask:
+        return mirrored_pos, mirrored_mask, True
+    return current_pos, mask, False
+
+def save_book(book_name, keys, vals, moves):
+    order = np.argsort(keys)
+    np.save(book_name + ".keys.npy", np.asarray(keys, dtype=np.uint64)[order])
+    np.save(book_name + ".vals.npy", np.asarray(vals, dtype=np.int8)[order])
+    np.save(book_name + ".moves.npy", np.asarray(moves, dtype=np.uint8)[order])
+
+class opening_book:
+    """ memory-mapped, read-only book. lookup() costs one binary search """
+    def __init__(self, book_name):
+        self.keys = np.load(book_name + ".keys.npy", mmap_mode='r')
+        self.vals = np.load(book_name + ".vals.npy", mmap_mode='r')
+        self.moves = np.load(book_name + ".moves.npy", mmap_mode='r')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, current_pos, mask):
+        """ returns (score, best move) of the position, or None if it is not in the book """
+        current_pos, mask, mirrored = canonical_position(current_pos, mask)
+        key = np.uint64(current_pos + mask)
+        index = np.searchsorted(self.keys, key)
+        if index == len(self.keys) or self.keys[index] != key:
+            return None
+        move = int(self.moves[index])
+        if mirrored:
+            move = width - 1 - move
+        return int(self.vals[index]), move
+
+
+def build_book(book_name, depth, book_solver=None, opening="", verbose=True):
+    """
+    Solves every position with at most 'depth' moves played, where the game is not over yet, and saves them to book_name.
+    opening: optional string of moves. Only positions reachable from it are stored, which makes smaller books for a given line
+    Positions are enumerated ply by ply, keeping one orientation of mirrored positions.
+    Only the deepest ply is searched. Every shallower position is scored from its children, which are all in the book already.
+    Returns the number of positions in the book
+    """
+    if book_solver is None:
+        book_solver = solver.solver()
+    start = C4_state()
+    start.play_string(opening)
+
+    #enumerate positions. plies[n] maps canonical key -> (current_pos, mask) for positions with n moves played
+    plies = [{} for n_moves in range(start.n_moves)]
+    start_pos, start_mask, mirrored = canonical_position(start.current_pos, start.mask)
+    plies.append({start_pos + start_mask: (start_pos, start_mask)})
+    for n_moves in range(start.n_moves, depth):
+        next_ply = {}
+        for current_pos, mask in plies[-1].values():
+            for move in range(width):
+                if mask & top_masks[move]: #column is full
+                    continue
+                new_pos, new_mask = book_solver.play(current_pos, mask, move)
+                if alignment(new_pos ^ new_mask): #game is over, nothing to store
+                    continue
+                new_pos, new_mask, mirrored = canonical_position(new_pos, new_mask)
+                next_ply[new_pos + new_mask] = (new_pos, new_mask)
+        plies.append(next_ply)
+
+    #score positions, deepest ply first
+    keys, vals, moves = [], [], []
+    scores = {} #canonical key -> score, for the ply below the one being scored
+    for n_moves in range(depth, start.n_moves - 1, -1):
+        ply_scores = {}
+        for counter, (key, (current_pos, mask)) in enumerate(plies[n_moves].items()):
+            if n_moves == depth:
+                move_scores = book_solver.solve(current_pos, mask, n_moves)
+            else:
+                move_scores = []
+                for move in range(width):
+                    if mask & top_masks[move]:
+                        move_scores.append('X')
+                        continue
+                    new_pos, new_mask = book_solver.play(current_pos, mask, move)
+                    if alignment(new_pos ^ new_mask):
+                        move_scores.append((43 - n_moves) // 2)
+                    else:
+                        child_pos, child_mask, mirrored = canonical_position(new_pos, new_mask)
+                        move_scores.append(-scores[child_pos + child_mask])
+            best_move = max(solver.move_order, key=lambda move: -100 if move_scores[move] == 'X' else move_scores[move]) #center first on ties
+            ply_scores[key] = move_scores[best_move]
+            keys.append(key)
+            vals.append(move_scores[best_move])
+            moves.append(best_move)
+            if verbose and n_moves == depth and counter % 1000 == 0:
+                print("solved", counter, "of", len(plies[n_moves]), "positions at depth", depth)
+        scores = ply_scores
+
+    save_book(book_name, keys, vals, moves)
+    return len(keys)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print(__doc__)
+        sys.exit(1)
+    n_positions = build_book(sys.argv[1], int(sys.argv[2]))
+    print("saved", n_positions, "positions to", sys.argv[1])
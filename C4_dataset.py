@@ -0,0 +1,314 @@
+"""
+Streaming access to training data sets that don't fit in memory.
+
+A data set is a directory of shards. A shard is either
+    - three .npy arrays side by side, which are memory-mapped: <name>.keys.npy, <name>.vals.npy, <name>.moves.npy
+      and optionally <name>.scores.npy, the exact score of every column (Nx7 int8, full_column for full columns)
+    - a .npz archive with 'hash_keys', 'hash_vals' and 'hash_moves', like data/training_set*.npz (loaded one shard at a time)
+
+batch_generator reads the shards chunk by chunk, shuffles through a bounded buffer,
+and unpacks the network inputs one batch at a time, so memory use doesn't grow with the data set.
+Positions are split into training and hold-out sets by a hash of their key (their canonical key when training on canonical keys), so the split is the same on every run and every machine.
+
+merge_datasets merges shards into one compact .npy shard (uint64 keys, int8 scores, uint8 moves), one record per key,
+optionally by canonical key and sorted by key for binary search lookups. Per-column scores are kept when every input has them. Converting an old .npz file is a merge of one input.
+Inputs larger than memory are streamed: records are first spread over bucket files by key, then each bucket is deduplicated on its own.
+
+Usage: python C4_dataset.py out_name input [input ...] [--exact input ...] [--canonical] [--unsorted]
+    inputs are shards (.npz files or .npy shard names) or directories of shards
+"""
+
+import os
+import sys
+import glob
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import C4_ANN
+from C4_batch import canonical_keys, canonical_moves
+
+shard_suffixes = {'keys': ".keys.npy", 'vals': ".vals.npy", 'moves': ".moves.npy", 'scores': ".scores.npy"}
+hash_multiplier = np.uint64(0x9E3779B97F4A7C15) #fibonacci hashing: spreads keys evenly over the top bits
+hash_shift = np.uint64(40)
+hash_range = 1 << 24
+max_score = 21 #scores are in [-21, 21], they fit in an int8
+full_column = -128 #score column entry of a column that can't be played
+record_dtype = np.dtype([('key', '<u8'), ('val', 'i1'), ('move', 'u1'), ('exact', 'u1')]) #bucket file records, 11 bytes
+scored_record_dtype = np.dtype(record_dtype.descr + [('scores', 'i1', (C4_ANN.n_possible_moves,))]) #with the per-column scores, 18 bytes
+
+
+def save_column(file_name, array):
+    """ np.save through a temporary file, so that a file under the final name is always complete """
+    with open(file_name + ".tmp", 'wb') as f:
+        np.save(f, array)
+    os.replace(file_name + ".tmp", file_name)
+
+def save_shard(shard_name, keys, vals, moves, scores=None):
+    """
+    saves a shard as three .npy arrays, plus the per-column scores if given.
+    The keys are written last: a shard is only listed once all its columns are there
+    """
+    if scores is not None:
+        save_column(shard_name + shard_suffixes['scores'], np.asarray(scores, dtype=np.int8).reshape(-1, C4_ANN.n_possible_moves))
+    save_column(shard_name + shard_suffixes['vals'], to_scores(vals))
+    save_column(shard_name + shard_suffixes['moves'], np.asarray(moves, dtype=np.uint8))
+    save_column(shard_name + shard_suffixes['keys'], np.asarray(keys, dtype=np.uint64))
+
+def to_scores(vals):
+    """ returns vals as int8. raises ValueError for values that are not scores """
+    vals = np.asarray(vals)
+    if len(vals) and (vals.min() < -max_score or vals.max() > max_score):
+        raise ValueError("scores must be in [-%d, %d], got values from %d to %d" % (max_score, max_score, vals.min(), vals.max()))
+    return vals.astype(np.int8)
+
+def list_shards(directory):
+    """ returns the sorted shard names of a data set directory (.npy shards without suffix, .npz shards with it) """
+    npy_shards = [path[:-len(shard_suffixes['keys'])] for path in glob.glob(os.path.join(directory, "*" + shard_suffixes['keys']))]
+    npz_shards = glob.glob(os.path.join(directory, "*.npz"))
+    return sorted(npy_shards + npz_shards)
+
+def load_shard(shard_name):
+    """ returns (keys, vals, moves) of a shard. .npy shards are memory-mapped, nothing is read until it's used """
+    if shard_name.endswith(".npz"):
+        data = np.load(shard_name)
+        return data['hash_keys'], data['hash_vals'], data['hash_moves']
+    return tuple(np.load(shard_name + shard_suffixes[column], mmap_mode='r') for column in ('keys', 'vals', 'moves'))
+
+def load_scores(shard_name):
+    """ returns the Nx7 per-column scores of a shard (memory-mapped), or None if the shard doesn't have them """
+    if shard_name.endswith(".npz"):
+        data = np.load(shard_name)
+        return data['hash_scores'] if 'hash_scores' in data else None
+    if not os.path.exists(shard_name + shard_suffixes['scores']):
+        return None
+    return np.load(shard_name + shard_suffixes['scores'], mmap_mode='r')
+
+def is_holdout(keys, test_fraction):
+    """ returns True for the keys that belong to the hold-out set. depends only on the key """
+    key_hash = (np.asarray(keys, dtype=np.uint64) * hash_multiplier) >> hash_shift #multiplication wraps around at 64 bits
+    return key_hash % np.uint64(hash_range) < np.uint64(test_fraction * hash_range)
+
+def in_split(keys, split, test_fraction, canonical=False):
+    """
+    returns True for the non-empty keys of the 'train' or 'test' split
+    canonical: split by the canonical key, so that a position and its mirror image are on the same side
+    """
+    split_keys = canonical_keys(keys)[0] if canonical else keys
+    return (keys != 0) & (is_holdout(split_keys, test_fraction) == (split == 'test'))
+
+def iterate_chunks(shards, split='train', test_fraction=0.1, chunk_size=1 << 20, rng=None, canonical=False):
+    """
+    yields (keys, vals, moves) chunks of the 'train' or 'test' split, skipping empty (zero key) slots.
+    with an rng, shards and the chunks of each shard are visited in random order. canonical: see in_split
+    """
+    shard_order = rng.permutation(len(shards)) if rng is not None else range(len(shards))
+    for shard_index in shard_order:
+        keys, vals, moves = load_shard(shards[shard_index])
+        chunk_starts = np.arange(0, len(keys), chunk_size)
+        if rng is not None:
+            rng.shuffle(chunk_starts)
+        for start in chunk_starts:
+            chunk_keys = np.asarray(keys[start:start + chunk_size])
+            keep = in_split(chunk_keys, split, test_fraction, canonical)
+            yield chunk_keys[keep], np.asarray(vals[start:start + chunk_size])[keep], np.asarray(moves[start:start + chunk_size])[keep]
+
+def count_records(shards, split='train', test_fraction=0.1, chunk_size=1 << 20, canonical=False):
+    """ number of positions in a split. reads only the keys. canonical: see in_split """
+    n_records = 0
+    for shard_name in shards:
+        keys = load_shard(shard_name)[0]
+        for start in range(0, len(keys), chunk_size):
+            n_records += np.count_nonzero(in_split(np.asarray(keys[start:start + chunk_size]), split, test_fraction, canonical))
+    return n_records
+
+def make_batch(keys, moves, canonical=False):
+    """
+    returns (network inputs, one-hot moves) for arrays of keys and moves
+    canonical: train on canonical keys only. mirrored positions are flipped, together with their moves
+    """
+    if canonical:
+        keys, mirrored = canonical_keys(keys)
+        moves = canonical_moves(moves, mirrored)
+    return C4_ANN.keys_to_bits(keys), np.eye(C4_ANN.n_possible_moves, dtype=np.float32)[moves]
+
+def shuffled(buffered_keys, buffered_moves, rng):
+    keys = np.concatenate(buffered_keys)
+    moves = np.concatenate(buffered_moves)
+    if rng is None:
+        return keys, moves
+    order = rng.permutation(len(keys))
+    return keys[order], moves[order]
+
+def batch_generator(directory, batch_size=256, split='train', test_fraction=0.1, shuffle_buffer=1 << 20,
+                    chunk_size=1 << 18, seed=None, loop=True, canonical=False):
+    """
+    yields (network inputs Nx56, one-hot moves Nx7) batches for keras' fit / evaluate / predict.
+    Chunks are collected until shuffle_buffer positions are buffered, shuffled together, and handed out as batches.
+    The 'test' split is never shuffled, so it comes out in the same order every time.
+    With loop=True the generator goes through the data set forever, with a new shuffle every pass, as keras expects
+    canonical: map every position to its canonical orientation (see make_batch), and split by canonical key (see in_split)
+    """
+    shards = list_shards(directory)
+    rng = np.random.default_rng(seed) if split == 'train' else None
+    while True:
+        buffered_keys, buffered_moves = [], []
+        n_buffered = 0
+        for keys, vals, moves in iterate_chunks(shards, split, test_fraction, chunk_size, rng, canonical):
+            buffered_keys.append(keys)
+            buffered_moves.append(moves)
+            n_buffered += len(keys)
+            if n_buffered >= shuffle_buffer:
+                keys, moves = shuffled(buffered_keys, buffered_moves, rng)
+                n_full = len(keys) - len(keys) % batch_size #the remainder stays in the buffer for the next round
+                for start in range(0, n_full, batch_size):
+                    yield make_batch(keys[start:start + batch_size], moves[start:start + batch_size], canonical)
+                buffered_keys, buffered_moves = [keys[n_full:]], [moves[n_full:]]
+                n_buffered = len(keys) - n_full
+        if n_buffered: #end of the data set: hand out what's left, including the last partial batch
+            keys, moves = shuffled(buffered_keys, buffered_moves, rng)
+            for start in range(0, len(keys), batch_size):
+                yield make_batch(keys[start:start + batch_size], moves[start:start + batch_size], canonical)
+        if not loop:
+            return
+
+
+def lookup_sorted(shard_name, keys):
+    """ returns (found, vals, moves) for an array of keys, in a shard sorted by key. vals and moves are 0 where found is False """
+    shard_keys, shard_vals, shard_moves = load_shard(shard_name)
+    keys = np.asarray(keys, dtype=np.uint64)
+    index = np.minimum(np.searchsorted(shard_keys, keys), max(len(shard_keys) - 1, 0))
+    found = (np.asarray(shard_keys[index]) == keys) if len(shard_keys) else np.zeros(len(keys), dtype=bool)
+    return found, np.where(found, shard_vals[index], 0).astype(np.int8), np.where(found, shard_moves[index], 0).astype(np.uint8)
+
+def expand_inputs(paths):
+    """ returns the shard names of a list of shards and directories of shards """
+    shards = []
+    for path in paths:
+        if os.path.isdir(path):
+            shards += list_shards(path)
+        elif path.endswith(".npz") or os.path.exists(path + shard_suffixes['keys']):
+            shards.append(path)
+        else:
+            raise ValueError("%s is neither a shard nor a directory of shards" % path)
+    return shards
+
+def iterate_records(shards, exact, canonical=False, chunk_size=1 << 20, scored=False):
+    """ yields record_dtype arrays (scored_record_dtype with scored=True) of all non-empty records in the shards, in chunks """
+    for shard_name in shards:
+        keys, vals, moves = load_shard(shard_name)
+        scores = load_scores(shard_name) if scored else None
+        for start in range(0, len(keys), chunk_size):
+            chunk_keys = np.asarray(keys[start:start + chunk_size])
+            keep = chunk_keys != 0
+            records = np.zeros(np.count_nonzero(keep), dtype=scored_record_dtype if scored else record_dtype)
+            records['key'] = chunk_keys[keep]
+            records['val'] = to_scores(np.asarray(vals[start:start + chunk_size])[keep])
+            records['move'] = np.asarray(moves[start:start + chunk_size])[keep]
+            records['exact'] = exact
+            if scored:
+                records['scores'] = np.asarray(scores[start:start + chunk_size])[keep]
+            if canonical:
+                records['key'], mirrored = canonical_keys(records['key'])
+                records['move'] = canonical_moves(records['move'], mirrored)
+                if scored:
+                    records['scores'][mirrored] = records['scores'][mirrored, ::-1] #column c of a mirrored position is column 6 - c
+            yield records
+
+def unique_records(records):
+    """
+    keeps one record per key. Scores of the solver's tables are upper bounds (exact for the positions that were searched
+    with an open window), so a record from an exact source wins, and otherwise the smallest, tightest bound
+    """
+    order = np.lexsort((records['val'], 1 - records['exact'], records['key']))
+    records = records[order]
+    first = np.ones(len(records), dtype=bool)
+    first[1:] = records['key'][1:] != records['key'][:-1]
+    return records[first]
+
+def bucket_boundaries(sources, n_buckets, canonical, chunk_size, n_records, sample_size=1 << 20):
+    """ key boundaries that split the records into n_buckets ranges of about the same size, from a sample of the keys """
+    stride = max(1, n_records // sample_size)
+    sample = np.concatenate([records['key'][::stride] for shards, exact in sources
+                             for records in iterate_records(shards, exact, canonical, chunk_size)])
+    sample.sort()
+    return sample[(np.arange(1, n_buckets) * len(sample)) // n_buckets]
+
+def merge_datasets(out_name, inputs, exact_inputs=(), canonical=False, sort=True, bucket_records=1 << 25, chunk_size=1 << 20, temp_dir=None):
+    """
+    merges shards and directories of shards into the .npy shard out_name, with one record per key. returns the number of records
+    exact_inputs: shards whose scores are exact. they win over the other inputs for the keys they have
+    canonical: fold mirrored positions together under the smaller key, with the moves (and per-column scores) given for that orientation
+    sort: sort the output by key. Otherwise the records are grouped by a hash of the key, which skips a pass over the inputs
+    bucket_records: records deduplicated at once. about 11 bytes each (18 with per-column scores), plus the sort
+    The per-column scores are merged along when every input has them. Raises ValueError if only some inputs have them
+    """
+    sources = [(expand_inputs(inputs), 0), (expand_inputs(exact_inputs), 1)]
+    has_scores = [load_scores(shard_name) is not None for shards, exact in sources for shard_name in shards]
+    scored = bool(has_scores) and all(has_scores)
+    if any(has_scores) and not scored:
+        raise ValueError("only some inputs have per-column scores, merging them would drop the scores")
+    bucket_dtype = scored_record_dtype if scored else record_dtype
+    n_records = sum(len(load_shard(shard_name)[0]) for shards, exact in sources for shard_name in shards)
+    n_buckets = max(1, -(-n_records // bucket_records))
+    if sort and n_buckets > 1:
+        boundaries = bucket_boundaries(sources, n_buckets, canonical, chunk_size, n_records)
+
+    temp_dir = tempfile.mkdtemp(dir=temp_dir if temp_dir else os.path.dirname(os.path.abspath(out_name)))
+    try:
+        bucket_files = [os.path.join(temp_dir, "bucket%d" % bucket) for bucket in range(n_buckets)]
+        bucket_handles = [open(file_name, 'wb') for file_name in bucket_files]
+        for shards, exact in sources:
+            for records in iterate_records(shards, exact, canonical, chunk_size, scored):
+                if n_buckets == 1:
+                    buckets = np.zeros(len(records), dtype=np.int64)
+                elif sort:
+                    buckets = np.searchsorted(boundaries, records['key'], side='right')
+                else:
+                    buckets = (((records['key'] * hash_multiplier) >> hash_shift) % np.uint64(n_buckets)).astype(np.int64)
+                order = np.argsort(buckets, kind='stable')
+                splits = np.searchsorted(buckets[order], np.arange(1, n_buckets))
+                for bucket, bucket_records_chunk in enumerate(np.split(records[order], splits)):
+                    bucket_handles[bucket].write(bucket_records_chunk.tobytes())
+        for handle in bucket_handles:
+            handle.close()
+
+        n_unique = []
+        for file_name in bucket_files: #deduplicate every bucket in place
+            records = unique_records(np.fromfile(file_name, dtype=bucket_dtype))
+            records.tofile(file_name)
+            n_unique.append(len(records))
+
+        columns = {column: np.lib.format.open_memmap(out_name + shard_suffixes[column], mode='w+', dtype=dtype, shape=(sum(n_unique),))
+                   for column, dtype in (('keys', np.uint64), ('vals', np.int8), ('moves', np.uint8))}
+        if scored:
+            columns['scores'] = np.lib.format.open_memmap(out_name + shard_suffixes['scores'], mode='w+', dtype=np.int8,
+                                                          shape=(sum(n_unique), C4_ANN.n_possible_moves))
+        start = 0
+        for file_name, n in zip(bucket_files, n_unique):
+            records = np.fromfile(file_name, dtype=bucket_dtype)
+            columns['keys'][start:start + n] = records['key']
+            columns['vals'][start:start + n] = records['val']
+            columns['moves'][start:start + n] = records['move']
+            if scored:
+                columns['scores'][start:start + n] = records['scores']
+            start += n
+        for column in columns.values():
+            column.flush()
+        return start
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge and deduplicate data sets into one compact shard")
+    parser.add_argument('out_name', help="output shard name, without the .keys.npy / .vals.npy / .moves.npy suffixes")
+    parser.add_argument('inputs', nargs='*', help=".npz files, .npy shard names or directories of shards")
+    parser.add_argument('--exact', nargs='*', default=[], help="inputs with exact scores, which win conflicts")
+    parser.add_argument('--canonical', action='store_true', help="deduplicate by canonical key")
+    parser.add_argument('--unsorted', action='store_true', help="don't sort the output by key")
+    parser.add_argument('--bucket-records', type=int, default=1 << 25, help="records deduplicated in memory at once")
+    args = parser.parse_args()
+    n_records = merge_datasets(args.out_name, args.inputs, args.exact, args.canonical, not args.unsorted, args.bucket_records)
+    print("saved", n_records, "records to", args.out_name)
+    sys.exit(0)
@@ -9,49 +9,144 @@ Functions:
 """
 
 import solver #Finds optimal move by a minimax search
-from tensorflow import keras #Chooses a move based on Neural Network recommendation
-from C4_position import C4_state, can_win_next, alignment #a position is a unique board state
+import C4_book #Exact moves for the opening, without search or inference
+from C4_position import C4_state, alignment, column_of, column_masks #a position is a unique board state
+import C4_ANN #Chooses a move based on Neural Network recommendation. Input encoding is shared with training
+import solver_anytime #Searches as deep as a time budget allows, for timed moves
+import time
 import numpy as np
-import math
 import sys
 
+default_model_files = {'keras': "project_ANN2", 'numpy': "project_ANN2.npz"}
+
+def forced_move(state, book=None):
+    """ returns the book move or an immediate winning move of a C4_state, or None if there is neither """
+    # If the position is in the opening book, play the book move
+    if book is not None:
+        book_entry = book.lookup( state.current_pos, state.mask )
+        if book_entry is not None:
+            return book_entry[1]
+
+    # If there is an immediate winning move, take it
+    winning_moves = state.move_masks()[2]
+    if winning_moves:
+        return column_of( winning_moves & -winning_moves ) #lowest winning column
+    return None
+
+def ranked_move(state, NN_prediction):
+    """ returns the move the ANN ranks best (NN_prediction: its 7 probabilities) that is legal and doesn't lose at once """
+    worst_to_best_move_order = np.argsort ( NN_prediction )
+    legal, non_losing, winning = state.move_masks()
+    
+    #Iterate through moves, best to worst. play the first one that doesn't immediately lose
+    for move in reversed(worst_to_best_move_order):
+        if non_losing & column_masks[move]:
+            return int(move)
+    
+    #if no non-losing moves were found, pick any legal move
+    return column_of( legal & -legal ) if legal else None
+
 class engine:
-    def __init__(self):   
+    """
+    book_name: optional opening book built by C4_book.py. Book positions are played from the book instead of the ANN
+    backend: 'keras' runs the saved keras model, 'numpy' runs the exported weights without importing tensorflow
+    model_file: model to load. Defaults to project_ANN2 (keras) or project_ANN2.npz (numpy)
+    canonical: the model was trained on canonical keys only. Mirrored positions are evaluated through their mirror image
+    solve_moves: timed moves (AI_move(time_ms)) are solved exactly from this many moves played, where solving takes milliseconds
+    timed: the engine will play timed moves. Everything they use is loaded and compiled now (see warm_up), so the first one keeps its budget
+    Otherwise the model and the solver are only loaded the first time they are used, so creating an engine is cheap
+    """
+    def __init__(self, book_name=None, backend='keras', model_file=None, canonical=False, solve_moves=24, timed=False):
+        if backend not in default_model_files:
+            raise ValueError("unknown backend '%s', expected 'keras' or 'numpy'" % backend)
         self.game_state = C4_state()
-        #  LOAD THE GAME AI
-        self.solver_AI = solver.solver()
-        self.ANN_AI = keras.models.load_model("project_ANN2")
+        self.book = C4_book.opening_book(book_name) if book_name else None
+        self.backend = backend
+        self.canonical = canonical
+        self.model_file = model_file if model_file else default_model_files[backend]
+        self.solve_moves = solve_moves
+        self.loaded_ANN = None
+        self.loaded_solver = None
+        self.loaded_anytime = None
+        if timed:
+            self.warm_up()
+
+    #  LOAD THE GAME AI, on first use
+    @property
+    def ANN_AI(self):
+        if self.loaded_ANN is None:
+            self.loaded_ANN = C4_ANN.load_model( self.model_file, self.backend )
+        return self.loaded_ANN
+
+    @property
+    def solver_AI(self):
+        if self.loaded_solver is None:
+            self.loaded_solver = solver.solver( book=self.book )
+        return self.loaded_solver
     
-    def AI_move(self):
-        # If there is an immediate winning move, take it
-        winning_moves = can_win_next( self.game_state.current_pos, self.game_state.mask ) 
-        if winning_moves:
-            first_set_bit =  math.log2(winning_moves & -winning_moves)+1 #return index of first '1'
-            move = math.floor( first_set_bit / 7) #winning column that should be played
-            self.game_state.play (move)
-            return
+    @property
+    def anytime_AI(self):
+        if self.loaded_anytime is None:
+            self.loaded_anytime = solver_anytime.anytime_search()
+        return self.loaded_anytime
+
+    def warm_up(self, timed=True):
+        """
+        loads the model and runs every compiled function a move uses once, so the first move isn't slower than the others.
+        timed: also the anytime search, and the solver if timed moves use it (solve_moves < 42).
+        Most of the compiled code is cached on disk, so after the first run this mostly loads it
+        """
+        state = C4_state()
+        forced_move( state )
+        ranked_move( state, self.evaluate_keys( [0] )[0] )
+        if timed:
+            self.anytime_AI #compiles its search when it is built
+            if self.solve_moves < 42:
+                self.solver_AI.benchmark( self.solver_AI.bench0_string ) #31 moves played: a few hundred nodes
+
+    def AI_move(self, time_ms=None):
+        self.game_state.play( self.choose_move(time_ms) )
+
+    def choose_move(self, time_ms=None):
+        """
+        returns the column the AI plays in self.game_state, without playing it
+        time_ms: optional time budget. The move is then searched (see timed_move) instead of taken from the ANN ranking
+        """
+        start = time.perf_counter()
+        move = forced_move( self.game_state, self.book )
+        if move is not None:
+            return move
         
+        if time_ms is not None:
+            return self.timed_move( time_ms - 1000 * (time.perf_counter() - start) )
+
         # else use ANN to order moves and let it pick best move 
         key = self.game_state.current_pos + self.game_state.mask
-        key_bits = [1 if digit=='1' else 0 for digit in format(key,'056b')]
-        NN_input = np.array ( [key_bits] )
-        NN_prediction = self.ANN_AI.predict ( NN_input )
-        worst_to_best_move_order = np.argsort ( NN_prediction )[0]
-        
-        #Iterate through moves, best to worst. play the first legal one that doesn't immediately lose
-        for move in reversed(worst_to_best_move_order):
-            if (not self.game_state.can_play(move)) or self.game_state.is_losing_move(move):
-                continue
-            self.game_state.play (move)
-            return
-        
-        #if no non-losing moves were found, pick any legal move
-        for move in range(7):
-            if( not self.game_state.can_play(move) ):
-                continue
-            self.game_state.play(move)
-            return
+        return ranked_move( self.game_state, self.evaluate_keys ( [key] )[0] )
     
+    def timed_move(self, time_ms):
+        """
+        Late in the game the position is solved exactly. Before that, the ANN ranks the moves and an anytime search
+        (solver_anytime) goes as deep as time_ms allows, starting with the ANN's favourite
+        """
+        start = time.perf_counter()
+        current_pos, mask, n_moves = self.game_state.current_pos, self.game_state.mask, self.game_state.n_moves
+        if n_moves >= self.solve_moves:
+            scores = self.solver_AI.solve( current_pos, mask, n_moves )
+            return solver.best_move( scores )
+        NN_prediction = self.evaluate_keys ( [current_pos + mask] )
+        best_to_worst_move_order = [int(move) for move in np.argsort ( NN_prediction )[0][::-1]]
+        time_left = time_ms - 1000 * (time.perf_counter() - start)
+        return self.anytime_AI.search( current_pos, mask, n_moves, time_left, best_to_worst_move_order )[0]
+
+    def evaluate_keys(self, keys):
+        """ returns an Nx7 array of move probabilities for an array of N keys (current_pos + mask), in one model call """
+        return C4_ANN.predict_keys( self.ANN_AI, keys, canonical=self.canonical )
+
+    def evaluate_positions(self, current_pos, mask):
+        """ returns an Nx7 array of move probabilities for arrays of N current_pos and mask bitboards """
+        return C4_ANN.predict_positions( self.ANN_AI, current_pos, mask, canonical=self.canonical )
+
     def human_move(self):
         # Keeps asking human to input a move until they input a valid move
         while True:
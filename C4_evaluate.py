@@ -0,0 +1,198 @@
+"""
+Evaluation of move-prediction networks on the hold-out set of a data set, and comparison of several of them.
+
+For every model the report gives
+    - top-k accuracy: the data set's move is among the k moves the network ranks highest, for k = 1 to 7
+    - top-1 and top-2 accuracy by number of moves played, since openings and endgames are not equally hard
+    - on shards with per-column scores (C4_label.py): how often the network's best legal move loses a position
+      that was not lost (losing_move_rate), and how often it is worse than the best move at all (mistake_rate)
+    - how often the network's favourite column is full (illegal_top1_rate). The engine skips those, the rates above do too
+    - inference throughput and per-call latency at several batch sizes, input encoding included
+
+Everything is computed on whole chunks of positions with array operations: ranks come from one argsort per chunk,
+and the per-move-count tables from bincount, so the metrics cost little next to the forward passes.
+
+Usage examples:
+    python C4_evaluate.py data --models project_ANN2.npz
+    python C4_evaluate.py data/labelled --models old.npz new.npz --json report.json
+    python C4_evaluate.py data --models project_ANN2 --backend keras
+"""
+
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import C4_ANN
+import C4_dataset
+from C4_batch import key_positions, u_top_masks
+
+n_possible_moves = C4_ANN.n_possible_moves
+max_moves = 42
+throughput_batch_sizes = (1, 16, 256, 4096)
+
+
+def move_ranks(predictions, moves):
+    """ returns the rank of each move in its row of predictions: 0 for the network's favourite. ties keep the column order """
+    order = np.argsort(-predictions, axis=1, kind='stable')
+    return np.argmax(order == np.asarray(moves).reshape(-1, 1), axis=1)
+
+def legal_moves(mask):
+    """ returns an Nx7 bool array, True where the column of a position isn't full """
+    return (np.asarray(mask, dtype=np.uint64).reshape(-1, 1) & u_top_masks) == 0
+
+def best_legal_moves(predictions, legal):
+    """ returns the legal move each position's predictions rank highest, like the engine's choice without its safety checks """
+    return np.argmax(np.where(legal, predictions, -np.inf), axis=1)
+
+
+class move_metrics:
+    """ counts accumulated over chunks of (keys, moves, predictions, per-column scores or None) """
+    def __init__(self):
+        self.rank_counts = np.zeros((max_moves + 1, n_possible_moves), dtype=np.int64) #positions by moves played and rank of the data set's move
+        self.n_illegal_top1 = 0
+        self.n_scored = 0
+        self.n_losing = 0
+        self.n_mistakes = 0
+
+    def add(self, keys, moves, predictions, scores=None):
+        current_pos, mask, n_moves = key_positions(keys)
+        ranks = move_ranks(predictions, moves)
+        self.rank_counts += np.bincount(n_moves * n_possible_moves + ranks, minlength=self.rank_counts.size).reshape(self.rank_counts.shape)
+        legal = legal_moves(mask)
+        self.n_illegal_top1 += int(np.count_nonzero(~legal[np.arange(len(keys)), np.argmax(predictions, axis=1)]))
+        if scores is not None:
+            scores = np.asarray(scores)
+            chosen_scores = scores[np.arange(len(keys)), best_legal_moves(predictions, legal)]
+            best_scores = scores.max(axis=1)
+            self.n_scored += len(keys)
+            self.n_losing += int(np.count_nonzero((chosen_scores < 0) & (best_scores >= 0)))
+            self.n_mistakes += int(np.count_nonzero(chosen_scores < best_scores))
+
+    def report(self):
+        n_positions = int(self.rank_counts.sum())
+        top_k = np.cumsum(self.rank_counts.sum(axis=0)) / max(n_positions, 1)
+        by_moves = {}
+        for n_moves in np.nonzero(self.rank_counts.sum(axis=1))[0]:
+            counts = self.rank_counts[n_moves]
+            by_moves[str(n_moves)] = {'positions': int(counts.sum()), 'top1': float(counts[0] / counts.sum()), 'top2': float(counts[:2].sum() / counts.sum())}
+        report = {'positions': n_positions, 'top_k': {str(k + 1): float(top_k[k]) for k in range(n_possible_moves)},
+                  'accuracy_by_moves': by_moves, 'illegal_top1_rate': self.n_illegal_top1 / max(n_positions, 1), 'scored_positions': self.n_scored}
+        if self.n_scored:
+            report['losing_move_rate'] = self.n_losing / self.n_scored
+            report['mistake_rate'] = self.n_mistakes / self.n_scored
+        return report
+
+
+def iterate_split(shards, split='test', test_fraction=0.1, chunk_size=1 << 20, canonical=False):
+    """ yields (keys, moves, per-column scores or None) chunks of the 'train' or 'test' split of the shards, in order. canonical: see C4_dataset.in_split """
+    for shard_name in shards:
+        keys, vals, moves = C4_dataset.load_shard(shard_name)
+        scores = C4_dataset.load_scores(shard_name)
+        for start in range(0, len(keys), chunk_size):
+            chunk_keys = np.asarray(keys[start:start + chunk_size])
+            keep = C4_dataset.in_split(chunk_keys, split, test_fraction, canonical)
+            chunk_scores = np.asarray(scores[start:start + chunk_size])[keep] if scores is not None else None
+            yield chunk_keys[keep], np.asarray(moves[start:start + chunk_size])[keep], chunk_scores
+
+def evaluate_model(model, data_dir, split='test', test_fraction=0.1, canonical=False, max_positions=None, chunk_size=1 << 20):
+    """
+    returns the accuracy report of a model on a split of a data set directory (see move_metrics.report),
+    with 'seconds' and 'positions_per_second' of the whole evaluation. max_positions: stop after about this many positions
+    """
+    metrics = move_metrics()
+    start = time.perf_counter()
+    n_positions = 0
+    for keys, moves, scores in iterate_split(C4_dataset.list_shards(data_dir), split, test_fraction, chunk_size, canonical):
+        if max_positions is not None:
+            if n_positions >= max_positions:
+                break
+            keys, moves = keys[:max_positions - n_positions], moves[:max_positions - n_positions]
+            scores = scores[:len(keys)] if scores is not None else None
+        if len(keys) == 0:
+            continue
+        metrics.add(keys, moves, C4_ANN.predict_keys(model, keys, canonical=canonical), scores)
+        n_positions += len(keys)
+    report = metrics.report()
+    report['seconds'] = time.perf_counter() - start
+    report['positions_per_second'] = n_positions / report['seconds']
+    return report
+
+def measure_throughput(model, keys, batch_sizes=throughput_batch_sizes, min_seconds=0.2, min_calls=5, canonical=False):
+    """ times predict_keys on batches of each size, over at least min_seconds and min_calls. returns one record per batch size """
+    keys = np.asarray(keys, dtype=np.uint64)
+    results = []
+    for batch_size in batch_sizes:
+        if len(keys) < batch_size:
+            continue
+        C4_ANN.predict_keys(model, keys[:batch_size], batch_size, canonical) #first call may compile or allocate
+        latencies = []
+        total_start = time.perf_counter()
+        while len(latencies) < min_calls or time.perf_counter() - total_start < min_seconds:
+            start = (len(latencies) * batch_size) % (len(keys) - batch_size + 1)
+            call_start = time.perf_counter()
+            C4_ANN.predict_keys(model, keys[start:start + batch_size], batch_size, canonical)
+            latencies.append(time.perf_counter() - call_start)
+        ms = 1000 * np.array(latencies)
+        results.append({'batch_size': batch_size, 'calls': len(ms), 'positions_per_second': batch_size * len(ms) / (ms.sum() / 1000),
+                        'p50_ms': float(np.percentile(ms, 50)), 'p99_ms': float(np.percentile(ms, 99))})
+    return results
+
+def compare_models(model_files, data_dir, backend='numpy', split='test', test_fraction=0.1, canonical=False, max_positions=None,
+                   batch_sizes=throughput_batch_sizes):
+    """ returns the reports of several models on the same positions, each with its 'model' and 'throughput' """
+    throughput_keys = None
+    for keys, moves, scores in iterate_split(C4_dataset.list_shards(data_dir), split, test_fraction, canonical=canonical):
+        throughput_keys = keys[:max(batch_sizes)]
+        break
+    reports = []
+    for model_file in model_files:
+        model = C4_ANN.load_model(model_file, backend)
+        report = {'model': model_file}
+        report.update(evaluate_model(model, data_dir, split, test_fraction, canonical, max_positions))
+        report['throughput'] = measure_throughput(model, throughput_keys, batch_sizes, canonical=canonical) if throughput_keys is not None else []
+        reports.append(report)
+    return reports
+
+def print_comparison(reports):
+    names = [report['model'] for report in reports]
+    width = max([12] + [len(name) for name in names])
+    print("%-*s %9s %7s %7s %7s %9s %8s %8s" % (width, "model", "positions", "top1", "top2", "top3", "illegal1", "losing", "mistake"))
+    for report in reports:
+        rates = ["%7.4f" % report['top_k'][k] for k in ('1', '2', '3')]
+        scored = ["%8.4f" % report[rate] if rate in report else "%8s" % "-" for rate in ('losing_move_rate', 'mistake_rate')]
+        print("%-*s %9d %s %9.4f %s" % (width, report['model'], report['positions'], " ".join(rates), report['illegal_top1_rate'], " ".join(scored)))
+    print("\ntop-1 accuracy by moves played")
+    print("%5s " % "moves" + " ".join("%*s" % (max(8, len(name)), name) for name in names))
+    all_moves = sorted({int(n) for report in reports for n in report['accuracy_by_moves']})
+    for n_moves in all_moves:
+        row = [report['accuracy_by_moves'].get(str(n_moves)) for report in reports]
+        print("%5d " % n_moves + " ".join("%*s" % (max(8, len(name)), "%.4f" % record['top1'] if record else "-") for name, record in zip(names, row)))
+    print("\nthroughput (positions per second, p50 / p99 ms per call)")
+    for report in reports:
+        print("%-*s " % (width, report['model']) + "  ".join("batch %d: %.0f/s, %.3f / %.3f ms" % (
+            record['batch_size'], record['positions_per_second'], record['p50_ms'], record['p99_ms']) for record in report['throughput']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate and compare move-prediction networks on a data set's hold-out positions")
+    parser.add_argument('data_dir')
+    parser.add_argument('--models', nargs='+', default=["project_ANN2.npz"], help="models to compare")
+    parser.add_argument('--backend', default='numpy')
+    parser.add_argument('--split', default='test', choices=('test', 'train'))
+    parser.add_argument('--test-fraction', type=float, default=0.1)
+    parser.add_argument('--canonical', action='store_true', help="the models were trained on canonical keys")
+    parser.add_argument('--max-positions', type=int, help="evaluate only about this many positions")
+    parser.add_argument('--json', help="write the reports to this file")
+    args = parser.parse_args(argv)
+
+    reports = compare_models(args.models, args.data_dir, args.backend, args.split, args.test_fraction, args.canonical, args.max_positions)
+    print_comparison(reports)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+"""
+Exact labels for training positions.
+
+The tables dumped by solver_main.py hold what the search happened to store: scores that are often only bounds from
+null window searches, and moves of nodes that were cut off. Here every position is solved column by column with solver.solve,
+so every record has the exact score of each column, the exact score of the position (the best column's),
+and a best move that really is best (ties go to the most central column).
+
+Records are written to fixed-size shards of a C4_dataset directory as they are finished, with the per-column scores
+in the shard's .scores.npy column. Memory stays the same however many positions are labelled:
+one shard buffer and the solver's table, which is reused from position to position since its entries stay exact.
+
+Positions come from a stream that is the same on every run: random boards from a seed, or the keys of existing data sets.
+After every shard a checkpoint file records how many positions of the stream are done, so a stopped run started again
+with the same arguments skips them and carries on with the next shard. Positions of an unfinished shard are solved again.
+
+Usage examples:
+    python C4_label.py data/labelled --positions 100000 --random-moves 16 --seed 0
+    python C4_label.py data/relabelled --from data (exact labels for the positions of an existing data set)
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import solver
+import C4_dataset
+from C4_position import width
+from C4_batch import C4_batch_state, key_positions, alignment
+
+checkpoint_name = "checkpoint.json"
+shard_prefix = "labels"
+
+
+def random_position_stream(n_random_moves, seed, chunk_size=4096):
+    """ yields (current_pos, mask, n_moves) of random boards where nobody has won, forever. chunk i is drawn from seed [seed, i] """
+    boards = C4_batch_state(chunk_size)
+    chunk = 0
+    while True:
+        boards.random_boards(n_random_moves, np.random.default_rng([seed, chunk]))
+        for i in range(chunk_size):
+            yield int(boards.current_pos[i]), int(boards.mask[i]), n_random_moves
+        chunk += 1
+
+def dataset_position_stream(inputs, chunk_size=1 << 16):
+    """ yields the positions of existing shards or data set directories, in order, skipping empty keys and finished games """
+    for shard_name in C4_dataset.expand_inputs(inputs):
+        keys = C4_dataset.load_shard(shard_name)[0]
+        for start in range(0, len(keys), chunk_size):
+            chunk_keys = np.asarray(keys[start:start + chunk_size])
+            current_pos, mask, n_moves = key_positions(chunk_keys[chunk_keys != 0])
+            for i in np.nonzero(~alignment(current_pos ^ mask) & (n_moves < 42))[0]: #skip finished games
+                yield int(current_pos[i]), int(mask[i]), int(n_moves[i])
+
+def label_position(label_solver, current_pos, mask, n_moves):
+    """ returns (key, score, best move, per-column scores) of a position where the game is not over """
+    scores = label_solver.solve(current_pos, mask, n_moves)
+    best_move = solver.best_move(scores)
+    column_scores = [C4_dataset.full_column if score == 'X' else score for score in scores]
+    return current_pos + mask, scores[best_move], best_move, column_scores
+
+
+class shard_writer:
+    """
+    collects records into a buffer of shard_size and saves it as the next shard of 'directory' when it is full.
+    Shards are named <prefix>_<number>, and the checkpoint is written after each of them
+    """
+    def __init__(self, directory, shard_size, config, prefix=shard_prefix):
+        self.directory = directory
+        self.shard_size = shard_size
+        self.prefix = prefix
+        self.config = config
+        self.keys = np.zeros(shard_size, dtype=np.uint64)
+        self.vals = np.zeros(shard_size, dtype=np.int8)
+        self.moves = np.zeros(shard_size, dtype=np.uint8)
+        self.scores = np.zeros((shard_size, width), dtype=np.int8)
+        self.n_buffered = 0
+        self.positions_done = 0 #positions of the stream in saved shards
+        self.n_shards = 0
+        os.makedirs(directory, exist_ok=True)
+        self.checkpoint_file = os.path.join(directory, checkpoint_name)
+        if os.path.exists(self.checkpoint_file):
+            with open(self.checkpoint_file) as f:
+                checkpoint = json.load(f)
+            if checkpoint['config'] != config:
+                raise ValueError("%s was written with %s, not %s. use another directory" % (self.checkpoint_file, checkpoint['config'], config))
+            self.positions_done = checkpoint['positions_done']
+            self.n_shards = checkpoint['n_shards']
+
+    def add(self, key, val, move, scores):
+        self.keys[self.n_buffered] = key
+        self.vals[self.n_buffered] = val
+        self.moves[self.n_buffered] = move
+        self.scores[self.n_buffered] = scores
+        self.n_buffered += 1
+        if self.n_buffered == self.shard_size:
+            self.flush()
+
+    def flush(self):
+        """ saves the buffered records as a shard (which may be smaller than shard_size) and writes the checkpoint """
+        if self.n_buffered == 0:
+            return
+        n = self.n_buffered
+        shard_name = os.path.join(self.directory, "%s_%06d" % (self.prefix, self.n_shards))
+        C4_dataset.save_shard(shard_name, self.keys[:n], self.vals[:n], self.moves[:n], self.scores[:n])
+        self.n_shards += 1
+        self.positions_done += n
+        self.n_buffered = 0
+        with open(self.checkpoint_file + ".tmp", 'w') as f:
+            json.dump({'positions_done': self.positions_done, 'n_shards': self.n_shards, 'config': self.config}, f)
+        os.replace(self.checkpoint_file + ".tmp", self.checkpoint_file)
+
+
+def label_positions(out_dir, positions, n_positions, config, shard_size=1 << 16, table_size=16777259, verbose=True):
+    """
+    labels the first n_positions positions of a stream (None: all of them) into shards of out_dir, resuming from its checkpoint.
+    config: the arguments that define the stream. A checkpoint written with another config is refused
+    returns the number of positions labelled in total
+    """
+    writer = shard_writer(out_dir, shard_size, config)
+    label_solver = solver.solver(table_size)
+    start = time.perf_counter()
+    n_done = 0
+    for index, (current_pos, mask, n_moves) in enumerate(positions):
+        if n_positions is not None and index >= n_positions:
+            break
+        if index < writer.positions_done: #labelled in an earlier run
+            continue
+        writer.add(*label_position(label_solver, current_pos, mask, n_moves))
+        n_done += 1
+        if verbose and n_done % 1000 == 0:
+            print("labelled %d positions, %.1f per second" % (writer.positions_done + writer.n_buffered, n_done / (time.perf_counter() - start)))
+    writer.flush()
+    return writer.positions_done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Label positions with exact scores into data set shards")
+    parser.add_argument('out_dir')
+    parser.add_argument('--positions', type=int, help="number of positions to label (default: all of --from)")
+    parser.add_argument('--random-moves', type=int, default=16, help="moves of the random boards")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--from', dest='inputs', nargs='*', help="label the positions of these shards or data set directories instead of random boards")
+    parser.add_argument('--shard-size', type=int, default=1 << 16)
+    parser.add_argument('--table-size', type=int, default=16777259)
+    args = parser.parse_args(argv)
+
+    if args.inputs:
+        config = {'inputs': args.inputs, 'shard_size': args.shard_size}
+        positions = dataset_position_stream(args.inputs)
+    else:
+        if args.positions is None:
+            parser.error("random boards need --positions")
+        config = {'random_moves': args.random_moves, 'seed': args.seed, 'shard_size': args.shard_size}
+        positions = random_position_stream(args.random_moves, args.seed)
+    n_labelled = label_positions(args.out_dir, positions, args.positions, config, args.shard_size, args.table_size)
+    print("%d positions labelled in %s" % (n_labelled, args.out_dir))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -23,12 +23,13 @@ height = 6
 width = 7
 all_bottom = (1<<0) | (1<<7) | (1<<14) | (1<<21) | (1<<28) | (1<<35) | (1<<42) #mask with bottom row of board = 1
 board_mask = all_bottom * ((1 << height) - 1) #mask with '1' in every real board position. Thus, all positions '1' except the top imaginary row
+column_masks = [((1 << height) - 1) << ((height + 1) * col) for col in range(width)] #the 6 real positions of each column
 
 
-""" returns a bitmask with winning free spots that make an alignment and are possible to play.
+""" returns a bitmask with all the free spots that would make an alignment for the stones in 'pos' (threats), playable or not.
     Looks complicated, but if you draw a bitboard and follow the rules you'll see how they work out. uses JIT compiled numba for speed"""
-@jit
-def can_win_next( pos, mask ):
+@jit(nopython=True, cache=True)
+def winning_positions( pos, mask ):
     #vertical
     r = ( pos << 1) & (pos << 2) & (pos << 3)
     
@@ -55,9 +56,63 @@ def can_win_next( pos, mask ):
     p = (pos >> (height + 2)) & (pos >> 2 * (height + 2));
     r |= p & (pos << (height + 2));
     r |= p & (pos >> 3 * (height + 2));
-    winning_pos =  r & (board_mask ^ mask);
+    return r & (board_mask ^ mask)
+
+
+""" returns a bitmask with winning free spots that make an alignment and are possible to play """
+@jit(nopython=True, cache=True)
+def can_win_next( pos, mask ):
+    possible = ( mask + all_bottom) & board_mask
+    return winning_positions( pos, mask ) & possible
+
+
+""" returns a bitmask of the possible moves that don't hand the opponent an immediate win. 0 if every move loses.
+    A move is losing if the opponent can win right now somewhere else (unless it's the only spot and we block it),
+    or if it's directly under a spot where the opponent would make an alignment """
+@jit(nopython=True, cache=True)
+def non_losing_moves( pos, mask ):
+    possible = ( mask + all_bottom) & board_mask
+    opponent_win = winning_positions( pos ^ mask, mask )
+    forced_moves = possible & opponent_win
+    if forced_moves:
+        if forced_moves & (forced_moves - 1): #opponent has more than one immediate win, we can't block them all
+            return 0
+        possible = forced_moves #we have to block the only one
+    return possible & ~(opponent_win >> 1)
+
+
+""" returns (legal moves, moves that don't lose at once, winning moves) of a position, as bitmasks with the stone each move would place.
+    One compiled call for everything a move picker needs """
+@jit(nopython=True, cache=True)
+def move_masks( pos, mask ):
     possible = ( mask + all_bottom) & board_mask
-    return winning_pos & possible 
+    return possible, non_losing_moves( pos, mask ), winning_positions( pos, mask ) & possible
+
+
+""" returns the number of '1's in a bitmask. one loop per set bit """
+@jit(nopython=True, cache=True)
+def popcount( m ):
+    count = 0
+    while m:
+        m &= m - 1
+        count += 1
+    return count
+
+
+""" returns the left-right mirror image of a bitboard. Works on 'pos', 'mask' or a key 'pos + mask',
+    because every column is a separate group of (height+1) bits and adding pos to mask never carries into the next column """
+@jit(nopython=True, cache=True)
+def mirror(bitboard):
+    column_mask = (1 << (height + 1)) - 1
+    mirrored = 0
+    for col in range(width):
+        mirrored |= ((bitboard >> ((height + 1) * col)) & column_mask) << ((height + 1) * (width - 1 - col))
+    return mirrored
+
+
+""" returns the column of a bitmask with a single stone, e.g. the lowest set bit 'm & -m' of a move mask. Python ints only """
+def column_of(bit):
+    return (bit.bit_length() - 1) // (height + 1)
 
 
 """ returns true if 4 stones align in the given bitmask 'pos' """
@@ -79,12 +134,16 @@ def alignment(pos):
 class C4_state:
     """
     Class which keeps track of the state of the game.
-    This consists of a 'current_pos' and 'mask' bitmasks
+    This consists of a 'current_pos' and 'mask' bitmasks, and the columns played since it was created or reset,
+    so moves can be taken back with undo() while searching
     """
+    __slots__ = ('current_pos', 'mask', 'n_moves', 'moves')
+
     def __init__(self, current=0, pos_mask=0, n_moves = 0 ):
         self.current_pos = current  #bitmap with '1' where there are current player stones
         self.mask = pos_mask        #bitmap with '1' anywhere there is a stone
         self.n_moves = n_moves
+        self.moves = []             #move stack
         
     #return number of '1's in a binary number. Don't use this function. it's too slow
     # def popcount(self,n):
@@ -95,12 +154,23 @@ class C4_state:
         self.current_pos = 0
         self.mask = 0
         self.n_moves = 0
+        self.moves.clear()
         
     """input: 0-based index of column to be played  """
     def play(self,move):
         self.current_pos ^= self.mask #switch current player with opponent
         self.mask |= self.mask + bottom_masks[move]
         self.n_moves += 1
+        self.moves.append(move)
+
+    """takes back the last move played, and returns its column. IndexError if no move was played since the state was created """
+    def undo(self):
+        move = self.moves.pop()
+        column = self.mask & column_masks[move]
+        self.mask ^= (column + bottom_masks[move]) >> 1 #the stones of a column are contiguous from the bottom, so this is the top one
+        self.current_pos ^= self.mask #the opponent's stones are the ones of the player to move again
+        self.n_moves -= 1
+        return move
 
     def play_string(self, col_string):
         for i in col_string:
@@ -133,9 +203,12 @@ class C4_state:
 
     """return True if move will result in a loss next turn, False otherwise"""
     def is_losing_move(self,col):
-        opponent_pos = C4_state( self.current_pos, self.mask, self.n_moves) # create a position from the current position, then play the move we're testing
-        opponent_pos.play ( col)
-        return bool ( can_win_next ( opponent_pos.current_pos, opponent_pos.mask ) ) #if opponent can win next, returns True
+        move_bit = (self.mask + bottom_masks[col]) & column_masks[col]
+        return bool ( can_win_next ( self.current_pos ^ self.mask, self.mask | move_bit ) ) #if opponent can win next, returns True
+
+    def move_masks(self):
+        """ returns (legal, non-losing, winning) move bitmasks, see move_masks. column_of gives the column of a single move """
+        return move_masks( self.current_pos, self.mask )
             
     def can_play(self,col):
         #Returns True if a column can be played, and false otherwise
@@ -147,22 +220,23 @@ class C4_state:
     
     ''' starts with empty board. plays n random moves. if game ends before n moves, resets board and tries again '''
     def random_board(self, n_moves):
-        self.current_pos = 0
-        self.mask = 0
-        possible_moves = [0,1,2,3,4,5,6]
-        for turn in range( n_moves ):
-            for move in range( len(possible_moves) ):
-                rand_move = random.choice ( possible_moves )
-                if self.can_play(rand_move):
-                    self.play(rand_move)
-                    break
-                else:
-                    possible_moves.remove(rand_move)
-                
-            last_pos = self.current_pos ^ self.mask    
-            if self.alignment( last_pos): #check if the last move made an alignment
-                self.random_board ( n_moves ) #if we made an alignment, then restart from the beginning
-        return
+        while True:
+            self.reset()
+            possible_moves = [0,1,2,3,4,5,6]
+            for turn in range( n_moves ):
+                for move in range( len(possible_moves) ):
+                    rand_move = random.choice ( possible_moves )
+                    if self.can_play(rand_move):
+                        self.play(rand_move)
+                        break
+                    else:
+                        possible_moves.remove(rand_move)
+
+                last_pos = self.current_pos ^ self.mask
+                if self.alignment( last_pos): #check if the last move made an alignment
+                    break #if we made an alignment, then restart from the beginning
+            else:
+                return
                                         
     def display_board(self):
         if (self.n_moves%2):
@@ -0,0 +1,260 @@
+"""
+Asyncio game server: many concurrent games against the ANN, with one model for all of them.
+
+Clients talk JSON lines over TCP (or a unix socket): one request object per line, one response object per line, in order.
+    {"op": "new", "ai_first": false}         -> {"game": id, ...state}   (with ai_first the AI has already played)
+    {"op": "move", "game": id, "column": c}  -> the human move, then the AI's answer: {"ai_column": c, ...state}
+    {"op": "ai_move", "game": id}            -> the AI plays for the player to move: {"ai_column": c, ...state}
+    {"op": "state", "game": id}              -> {...state}
+    {"op": "close", "game": id}              -> {"closed": id}
+    {"op": "metrics"}                        -> counters and latency percentiles
+    state: {"game", "current_pos", "mask", "n_moves", "result"}. result is null while the game goes on,
+    then "win" (the player who moved last won) or "draw". Errors come back as {"error": message}
+
+Games are rows of a C4_batch_state: two uint64 bitboards and a move count per game, about 24 bytes, so thousands of games cost nothing.
+AI moves that need the network wait in a bounded queue. A batching task collects them across games into one model call,
+as soon as max_batch positions are waiting or the oldest has waited max_wait_ms. When the queue is full,
+new AI moves wait to be queued, and their connections are not read until then, so the clients slow down with the server (backpressure).
+
+Usage: python C4_server.py [--port 8765] [--unix path] [--model project_ANN2.npz] [--max-batch 256] [--max-wait-ms 2]
+"""
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import collections
+import numpy as np
+import C4_ANN
+import C4_book
+from C4_engine import forced_move, ranked_move
+from C4_position import C4_state, alignment, width
+from C4_batch import C4_batch_state
+
+latency_window = 10000 #latencies kept for the percentiles, most recent first
+
+
+class micro_batcher:
+    """ collects single positions from many coroutines into batched calls of model.predict """
+    def __init__(self, model, max_batch=256, max_wait_ms=2.0, max_queue=4096, canonical=False):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.canonical = canonical
+        self.queue = asyncio.Queue(max_queue)
+        self.n_batches = 0
+        self.n_positions = 0
+
+    async def evaluate(self, key):
+        """ returns the model's 7 move probabilities for a key. waits while the queue is full """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((key, future))
+        return await future
+
+    async def run(self):
+        """ batching loop. runs until cancelled """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            keys = [key for key, future in batch]
+            try: #the model runs in a thread, so the server keeps reading requests meanwhile
+                predictions = await loop.run_in_executor(None, C4_ANN.predict_keys, self.model, keys, self.max_batch, self.canonical)
+            except Exception as error:
+                for key, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            self.n_batches += 1
+            self.n_positions += len(batch)
+            for (key, future), prediction in zip(batch, predictions):
+                if not future.done(): #the client may have gone away
+                    future.set_result(prediction)
+
+
+class game_server:
+    """
+    model: model with a keras-like predict() (see C4_ANN.load_model)
+    max_games: games held at once. new games are refused beyond it
+    book: optional C4_book.opening_book. book moves are played without the model
+    """
+    def __init__(self, model, max_games=100000, max_batch=256, max_wait_ms=2.0, max_queue=4096, book=None, canonical=False):
+        self.games = C4_batch_state(max_games)
+        self.over = np.zeros(max_games, dtype=np.int8) #0: game goes on, 1: the player who moved last won, 2: draw
+        self.free_rows = list(range(max_games - 1, -1, -1))
+        self.rows = {} #game id -> row of self.games
+        self.next_id = 0
+        self.book = book
+        self.batcher = micro_batcher(model, max_batch, max_wait_ms, max_queue, canonical)
+        self.counters = collections.Counter()
+        self.latencies = collections.deque(maxlen=latency_window)
+
+    def load(self, row):
+        return C4_state(int(self.games.current_pos[row]), int(self.games.mask[row]), int(self.games.n_moves[row]))
+
+    def store(self, row, state):
+        self.games.current_pos[row] = state.current_pos
+        self.games.mask[row] = state.mask
+        self.games.n_moves[row] = state.n_moves
+        if alignment(state.current_pos ^ state.mask):
+            self.over[row] = 1
+        elif state.check_draw():
+            self.over[row] = 2
+
+    def describe(self, game_id):
+        row = self.rows[game_id]
+        return {'game': game_id, 'current_pos': int(self.games.current_pos[row]), 'mask': int(self.games.mask[row]),
+                'n_moves': int(self.games.n_moves[row]), 'result': [None, 'win', 'draw'][self.over[row]]}
+
+    def row_of(self, request):
+        game_id = request.get('game')
+        if game_id not in self.rows:
+            raise ValueError("unknown game %r" % game_id)
+        return game_id, self.rows[game_id]
+
+    def play(self, row, column):
+        if self.over[row]:
+            raise ValueError("the game is over")
+        state = self.load(row)
+        if not (isinstance(column, int) and not isinstance(column, bool) and 0 <= column < width and state.can_play(column)):
+            raise ValueError("illegal move %r" % column)
+        state.play(column)
+        self.store(row, state)
+
+    async def ai_move(self, game_id, row):
+        """ plays the AI's move in a game and returns its column """
+        if self.over[row]:
+            raise ValueError("the game is over")
+        state = self.load(row)
+        move = forced_move(state, self.book)
+        if move is None:
+            move = ranked_move(state, await self.batcher.evaluate(state.current_pos + state.mask))
+            if self.rows.get(game_id) != row: #closed while we waited for the model. its row may hold another game by now
+                raise ValueError("game %r was closed while the AI was thinking" % game_id)
+            if (int(self.games.current_pos[row]), int(self.games.mask[row])) != (state.current_pos, state.mask):
+                raise ValueError("the game changed while the AI was thinking") #the move was picked for the position before
+        state = self.load(row)
+        state.play(move)
+        self.store(row, state)
+        return move
+
+    async def handle(self, request):
+        """ returns the response to one request """
+        op = request.get('op')
+        if op == 'new':
+            if not self.free_rows:
+                raise ValueError("server is full")
+            game_id, row = self.next_id, self.free_rows.pop()
+            self.next_id += 1
+            self.rows[game_id] = row
+            self.games.reset([row])
+            self.over[row] = 0
+            response = {}
+            if request.get('ai_first'):
+                response['ai_column'] = await self.ai_move(game_id, row)
+            response.update(self.describe(game_id))
+            return response
+        if op == 'move':
+            game_id, row = self.row_of(request)
+            self.play(row, request.get('column'))
+            response = {}
+            if not self.over[row]:
+                response['ai_column'] = await self.ai_move(game_id, row)
+            response.update(self.describe(game_id))
+            return response
+        if op == 'ai_move':
+            game_id, row = self.row_of(request)
+            response = {'ai_column': await self.ai_move(game_id, row)}
+            response.update(self.describe(game_id))
+            return response
+        if op == 'state':
+            return self.describe(self.row_of(request)[0])
+        if op == 'close':
+            game_id, row = self.row_of(request)
+            del self.rows[game_id]
+            self.free_rows.append(row)
+            return {'closed': game_id}
+        if op == 'metrics':
+            return self.metrics()
+        raise ValueError("unknown op %r" % op)
+
+    def metrics(self):
+        latencies = 1000 * np.array(self.latencies) if self.latencies else np.zeros(1)
+        batcher = self.batcher
+        return {'requests': dict(self.counters), 'games': len(self.rows), 'queued': batcher.queue.qsize(),
+                'batches': batcher.n_batches, 'mean_batch': batcher.n_positions / batcher.n_batches if batcher.n_batches else 0.0,
+                'latency_ms': {'p50': float(np.percentile(latencies, 50)), 'p90': float(np.percentile(latencies, 90)),
+                               'p99': float(np.percentile(latencies, 99)), 'max': float(latencies.max())}}
+
+    async def serve_client(self, reader, writer):
+        """ answers the requests of one connection, one line at a time, in order """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                start = time.perf_counter()
+                try:
+                    request = json.loads(line)
+                    self.counters[request.get('op', 'none')] += 1
+                    response = await self.handle(request)
+                except (ValueError, TypeError, AttributeError) as error: #bad json, bad request, illegal move
+                    self.counters['errors'] += 1
+                    response = {'error': str(error)}
+                self.latencies.append(time.perf_counter() - start)
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain() #waits while the client isn't reading its answers
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765, unix_path=None):
+        batching = asyncio.ensure_future(self.batcher.run())
+        if unix_path:
+            server = await asyncio.start_unix_server(self.serve_client, unix_path)
+        else:
+            server = await asyncio.start_server(self.serve_client, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batching.cancel()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve Connect Four games against the ANN over JSON lines")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', help="listen on this unix socket instead of TCP")
+    parser.add_argument('--model', default="project_ANN2.npz")
+    parser.add_argument('--backend', default='numpy')
+    parser.add_argument('--book', help="opening book built by C4_book.py")
+    parser.add_argument('--canonical', action='store_true', help="the model was trained on canonical keys")
+    parser.add_argument('--max-games', type=int, default=100000)
+    parser.add_argument('--max-batch', type=int, default=256)
+    parser.add_argument('--max-wait-ms', type=float, default=2.0)
+    parser.add_argument('--max-queue', type=int, default=4096)
+    args = parser.parse_args(argv)
+
+    server = game_server(C4_ANN.load_model(args.model, args.backend), args.max_games, args.max_batch, args.max_wait_ms,
+                         args.max_queue, C4_book.opening_book(args.book) if args.book else None, args.canonical)
+    print("serving on", args.unix if args.unix else "%s:%d" % (args.host, args.port))
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
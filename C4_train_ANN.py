@@ -9,45 +9,31 @@ Loads data from training set containing 'keys', 'values', and 'moves'
     - move:
         Number which is the optimal move that maximizes value for current player
         
-Loads a training data set and a test data set for verification and checking for overfitting
+Streams a training data set and a hold-out test data set for verification and checking for overfitting
         
 
 """
 
 from tensorflow import keras
-from sklearn.model_selection import train_test_split
-import numpy as np
-
-#LOAD DATA AND EXTRACT KEYS, VALUES, AND MOVES
-all_data = np.load( "data/training_set4.npz" )
-hash_keys = all_data['hash_keys']
-hash_vals = all_data['hash_vals']
-hash_moves = all_data['hash_moves']
-
-good_ind = np.nonzero(hash_keys)
-hash_keys = hash_keys [ good_ind ]
-hash_vals = hash_vals [ good_ind ]
-hash_moves = hash_moves[good_ind ]
-
-
-#change each entry in hash_keys from 64-bit int to 8 8-bit ints. 
-#Then reshapes to Nx8. then removes the last column, so size is Nx7, because we only use 56 bits
-reshaped_keys = np.reshape ( hash_keys.view(np.uint8), [len(hash_keys),8] )[:, :-1]
-
-#change the 7 8-bit numbers to 56 values of '0' or '1'. array is now Nx56, ready for input into Neural Network
-bit_keys = np.reshape ( np.unpackbits( reshaped_keys ), [ len(reshaped_keys), 56 ] )
-
-#FORMAT THE OUTPUT: HASH VALS SO THAT THEY ARE EITHER +1, -1, OR ZERO
-hash_vals [ np.where(hash_vals > 0) ] = 1
-hash_vals [ np.where(hash_vals < 0) ] = -1
-n_possible_moves = 7
-moves_training = keras.utils.to_categorical(hash_moves, n_possible_moves)
-
-#Split training and test data:
-X_train, X_test, y_train, y_test = train_test_split( bit_keys, moves_training, test_size=0.10)
+import C4_ANN
+import C4_dataset
+import C4_evaluate
+
+#DATA SET: a directory of shards (see C4_dataset.py), read lazily so it can be much larger than memory
+data_dir = "data"
+batch_size = 256
+test_fraction = 0.10 #share of positions held out for testing, chosen by a hash of their key
+n_possible_moves = C4_ANN.n_possible_moves
+canonical = False #train on canonical keys only (mirrored positions folded together). The engine must then run with canonical=True
+
+#each batch is unpacked from keys to 56 values of '0' or '1' and one-hot moves when it's needed
+#the engine uses the same encoding (C4_ANN.keys_to_bits), so the network sees the same input when it plays
+shards = C4_dataset.list_shards( data_dir )
+n_train = C4_dataset.count_records( shards, 'train', test_fraction, canonical=canonical )
+train_batches = C4_dataset.batch_generator( data_dir, batch_size, 'train', test_fraction, canonical=canonical )
 
 model = keras.Sequential()
-model.add(keras.layers.Dense(56, input_shape = (56,),activation='tanh'))
+model.add(keras.layers.Dense(56, input_shape = (C4_ANN.n_input_bits,),activation='tanh'))
 model.add(keras.layers.Dense(30, activation='relu'))
 model.add(keras.layers.Dense(20, activation='relu'))
 model.add(keras.layers.Dense(10, activation='relu'))
@@ -57,26 +43,15 @@ model.compile(loss=keras.losses.categorical_crossentropy,
               optimizer=keras.optimizers.Adam(),
 metrics=['accuracy'])
 
-model.fit(X_train, y_train, epochs=2)
-
-
-predictions = model.predict ( X_test )
-n_correct1 = 0 #correctly predicted moves
-n_correct2 = 0 #almost correctly predicted moves (i.e. the second-best guess was correct)
-n_wrong = 0
+model.fit(train_batches, steps_per_epoch = -(-n_train // batch_size), epochs=2)
 
-for i in range(len(predictions)):
-    true_move = np.argmax ( y_test[i] )
-    predicted_best_moves = [list(predictions[i]).index(x) for x in sorted(predictions[i], reverse=True)[:7]]
-    if ( true_move == predicted_best_moves[0] ):
-        n_correct1 += 1
-    elif (true_move == predicted_best_moves[1]):
-        n_correct2 += 1
-    else:
-        n_wrong += 1
 
-print ( "%Correct1: ", n_correct1 / (n_correct1 + n_correct2 +n_wrong) )
-print ( "%almost Correct1: ", (n_correct1 + n_correct2) / (n_correct1 + n_correct2 +n_wrong) )
+#accuracy on the hold-out set: top-k, by moves played, and losing moves where the data set has per-column scores (see C4_evaluate.py)
+report = C4_evaluate.evaluate_model( model, data_dir, 'test', test_fraction, canonical=canonical )
+print ( "%Correct1: ", report['top_k']['1'] )
+print ( "%almost Correct1: ", report['top_k']['2'] )
+if 'losing_move_rate' in report:
+    print ( "%Losing moves: ", report['losing_move_rate'] )
 
 #model.save("project_ANN2")
 
@@ -7,12 +7,258 @@ given a board, returns its 'value' = number of turns to win/lose
 
 """
 
+import json
 import numpy as np
-from C4_position import C4_state, can_win_next, alignment
+from numba import jit
+from C4_position import C4_state, can_win_next, alignment, height, width, winning_positions, non_losing_moves, popcount, mirror
+from C4_batch import C4_batch_state
+from solver_table import transposition_table, table_lookup, table_store, info_value, store_skipped, store_overwrote
+from solver_policy import move_policy, sort_moves_policy, guide_max_ply
 
+move_order = (3, 2, 4, 1, 5, 0, 6) #center columns first, they take part in more alignments
+column_mask = (1 << height) - 1 #real spots of the first column. shift by (height+1)*col for the others
 
-class solver:
+#indices of the search statistics counters
+stat_nodes = 0 #calls of negamax
+stat_probes = 1 #transposition table lookups
+stat_hits = 2 #lookups that found the position
+stat_collisions = 3 #lookups that found a different position in the slot
+stat_stores = 4 #entries written to the table
+stat_overwrites = 5 #stores that replaced a different position
+stat_store_skips = 6 #stores refused by the replacement policy
+stat_win_exits = 7 #nodes that returned early because can_win_next found a win
+stat_cutoffs = 8 #beta cutoffs
+stat_iterations = 9 #null window searches of iterative_eval
+stat_policy_calls = 10 #nodes ordered by the network
+stat_policy_hits = 11 #of those, nodes whose network scores were cached
+stat_ply_nodes = 12 #nodes by number of moves played: 43 counters
+stat_cutoff_index = stat_ply_nodes + 43 #beta cutoffs by index of the move in the sorted move list: 7 counters
+n_stats = stat_cutoff_index + width
+
+
+""" Compiled search path. These functions run entirely in nopython mode over the transposition table arrays,
+    so a node costs a few machine instructions instead of Python calls and NumPy boxing.
+    The solver class below is a thin wrapper that owns the tables and passes them in """
+@jit(nopython=True, cache=True)
+def play_move(pos, mask, move):
+    pos ^= mask
+    mask |= mask + (1 << ((height + 1) * move)) #bottom mask of column 'move'
+    return pos, mask
+
+""" sorts the non-losing moves of a position into sort_moves, best first, and returns how many there are.
+    moves that create more threats (free spots where we would make an alignment) come first. ties keep the center-first move_order.
+    Insertion sort into a preallocated row of the sort buffer, so nothing is allocated per node """
+@jit(nopython=True, cache=True)
+def sort_moves_kernel(current_pos, mask, next_moves, sort_moves, sort_scores):
+    n_sorted = 0
+    for move in move_order:
+        move_bit = next_moves & (column_mask << ((height + 1) * move))
+        if move_bit == 0:
+            continue
+        score = popcount( winning_positions(current_pos | move_bit, mask | move_bit) )
+        i = n_sorted
+        while i > 0 and sort_scores[i-1] < score: #strictly smaller, so equal scores stay in move_order
+            sort_moves[i] = sort_moves[i-1]
+            sort_scores[i] = sort_scores[i-1]
+            i -= 1
+        sort_moves[i] = move
+        sort_scores[i] = score
+        n_sorted += 1
+    return n_sorted
+
+""" abort: None, or a 1-element array. Once abort[0] is set, the search unwinds at once and returns a meaningless score, storing nothing """
+@jit(nopython=True)
+def negamax_kernel(current_pos, mask, n_moves, alpha, beta, table_keys, table_infos, policy, sort_buffer, canonical, guide, stats, abort):
+    if abort is not None and abort[0]: #set by another process (see solver_parallel). None compiles the check away
+        return 0
+    if stats is not None: #stats is None when statistics are off. numba then compiles the counting away
+        stats[stat_nodes] += 1
+        stats[stat_ply_nodes + n_moves] += 1
+
+    if( n_moves == 42): # check for draw. if so, return 0
+        return 0
+
+    if can_win_next(current_pos, mask): #if we end the game here, then we know the score. return score.
+        if stats is not None:
+            stats[stat_win_exits] += 1
+        return ( ( 43 - n_moves ) ) // 2 #integer division by 2
+
+    next_moves = non_losing_moves(current_pos, mask)
+    if next_moves == 0: #every move lets the opponent win on their next turn
+        return -( ( 42 - n_moves ) // 2 )
+
+    if n_moves >= 40: #no one can win with the last 2 moves, since we don't lose to the opponent's last move
+        return 0
+
+    # GET LOWER BOUND OF SCORE. the opponent can't win on their next move
+    min_score = -( ( 40 - n_moves ) // 2 )
+    if alpha < min_score:
+        alpha = min_score
+        if alpha >= beta:
+            return alpha
+
+    # GET UPPER BOUND OF SCORE. USE TO UPDATE BETA
+    max_score = (41 - n_moves)//2  #Get upper bound of score
+    highscore = -1 * max_score
+    best_move = 0
+
+    key = current_pos + mask #this operation produces a unique key for each board
+    mirrored = False
+    if canonical: #mirrored positions have the same score, so they share the entry of the smaller key
+        mirrored_key = mirror(key)
+        if mirrored_key < key:
+            key = mirrored_key
+            mirrored = True
+    info = table_lookup(table_keys, table_infos, key)
+    if (info != 0):
+        max_score = info_value(info)
+    if stats is not None:
+        stats[stat_probes] += 1
+        if info != 0:
+            stats[stat_hits] += 1
+        elif table_infos[key % table_infos.shape[0]] != 0:
+            stats[stat_collisions] += 1
+
+    if (beta > max_score):
+        beta = max_score # no need to keep beta above maximum
+        if alpha>=beta:
+            return beta #terminate if [alpha;beta] is empty
+
+    sort_moves = sort_buffer[n_moves, 0] #this ply's row of the buffer. deeper plies use other rows
+    if guide is not None and n_moves < guide[guide_max_ply]: #close to the root, order by the network (see solver_policy)
+        n_sorted, cache_hit = sort_moves_policy(current_pos, mask, next_moves, sort_moves, sort_buffer[n_moves, 1], guide)
+        if stats is not None:
+            stats[stat_policy_calls] += 1
+            if cache_hit:
+                stats[stat_policy_hits] += 1
+    else:
+        n_sorted = sort_moves_kernel(current_pos, mask, next_moves, sort_moves, sort_buffer[n_moves, 1])
+    for i in range(n_sorted):
+        move = sort_moves[i]
+        new_pos, new_mask = play_move(current_pos, mask, move)
+        if guide is not None and n_moves + 1 < guide[guide_max_ply]:
+            score = - negamax_kernel( new_pos, new_mask, n_moves + 1, -beta, -alpha, table_keys, table_infos, policy, sort_buffer, canonical, guide, stats, abort )
+        else: #below the network's plies, search without it. the plain search doesn't carry the weights through every call
+            score = - negamax_kernel( new_pos, new_mask, n_moves + 1, -beta, -alpha, table_keys, table_infos, policy, sort_buffer, canonical, None, stats, abort )
+        if abort is not None and abort[0]: #the score is meaningless, and so is this node's
+            return 0
+
+        if score > highscore:
+            best_move = move
+            highscore = score
+
+        if score>=beta:
+            if stats is not None:
+                stats[stat_cutoffs] += 1
+                stats[stat_cutoff_index + i] += 1
+            return score  #PRUNE WHEN WE FIND A MOVE BETTER THAN SCORE THAT OPPONENT CAN FORCE US INTO
+
+        if score>alpha:
+            alpha = score  #ONLY TRACK SCORES BETTER THAN THE BEST SO FAR
+
+    if mirrored:
+        best_move = width - 1 - best_move #store the move for the orientation of the stored key
+    stored = table_store(table_keys, table_infos, policy, key, alpha, best_move, n_moves) #once we evaluated a position, we keep its score in the transposition table
+    if stats is not None:
+        if stored == store_skipped:
+            stats[stat_store_skips] += 1
+        else:
+            stats[stat_stores] += 1
+            if stored == store_overwrote:
+                stats[stat_overwrites] += 1
+    return alpha
+
+@jit(nopython=True)
+def iterative_eval_kernel(current_pos, mask, n_moves, table_keys, table_infos, policy, sort_buffer, canonical, guide, stats):
+    min_val = -( 42 - n_moves ) // 2
+    max_val =  ( 43 - n_moves ) // 2
+    while (min_val < max_val):
+        med_val = (min_val + max_val) // 2 #I don't really understand those 4 lines of code. roughly, we are picking 'med_val' between max_val and min_val
+        if (med_val <= 0 and min_val//2 < med_val):
+            med_val = min_val//2
+        elif (med_val >= 0 and max_val//2 > med_val):
+            med_val = max_val//2
+
+        if stats is not None:
+            stats[stat_iterations] += 1
+        r = negamax_kernel(current_pos, mask, n_moves, med_val, med_val+1, table_keys, table_infos, policy, sort_buffer, canonical, guide, stats, None)
+        if(r <= med_val):
+            max_val = r
+        else:
+            min_val = r
+
+    return min_val
+
+
+def best_move(scores):
+    """ returns the best column of solve() scores ('X' for full columns). ties go to the most central column """
+    return max((move for move in move_order if scores[move] != 'X'), key=lambda move: scores[move])
+
+
+class search_stats:
+    """
+    counters filled by the compiled search, for solvers created with stats=True.
+    The search writes into one int64 array (see the stat_ indices), the rest is bookkeeping done outside the search
+    """
     def __init__(self):
+        self.counters = np.zeros(n_stats, dtype=np.int64)
+        self.iterations_per_eval = [] #null window searches of each iterative_eval call
+
+    def reset(self):
+        self.counters.fill(0)
+        self.iterations_per_eval = []
+
+    def as_dict(self):
+        c = [int(count) for count in self.counters]
+        probes = c[stat_probes]
+        return {
+            'nodes': c[stat_nodes],
+            'nodes_per_ply': c[stat_ply_nodes:stat_ply_nodes + 43],
+            'beta_cutoffs': c[stat_cutoffs],
+            'cutoffs_by_move_index': c[stat_cutoff_index:stat_cutoff_index + width],
+            'probes': probes,
+            'hits': c[stat_hits],
+            'hit_rate': c[stat_hits] / probes if probes else 0.0,
+            'collisions': c[stat_collisions],
+            'stores': c[stat_stores],
+            'overwrites': c[stat_overwrites],
+            'store_skips': c[stat_store_skips],
+            'win_exits': c[stat_win_exits],
+            'null_window_iterations': c[stat_iterations],
+            'policy_calls': c[stat_policy_calls],
+            'policy_cache_hits': c[stat_policy_hits],
+            'iterations_per_eval': list(self.iterations_per_eval),
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.as_dict(), **kwargs)
+
+
+class solver:
+    """
+    table_size: number of slots in the transposition table. 5 bytes per slot from 2^24 slots on (the default), 6 below (see solver_table)
+    policy: replacement policy of the transposition table, 'always' or 'depth'
+    book: optional C4_book.opening_book. Positions found in the book are not searched
+    canonical: if True, a position and its mirror image share one table entry, stored under the smaller key
+    stats: if True, the search fills self.stats (a search_stats) with node, cutoff and table counters. Off costs nothing
+    table_file: optional file holding the transposition table (see solver_table). The search resumes with every entry
+        an earlier run left in it, and its own entries stay in the file for the next run
+    table_buffer: optional shared memory holding the transposition table instead (see solver_table), for searches
+        of several processes on one table (see solver_parallel.parallel_solver)
+    ordering_model: optional network weights (.npz from C4_ANN.export_weights) that break move ordering ties in the first
+        ordering_depth plies of every search (see solver_policy). Scores don't change, only the number of nodes
+    """
+    #Benchmarks, from easiest to hardest. Class attributes, so they can be read without building a table
+    bench0_string = "2021230311144455655432233441660"
+    bench1_string = "20212303111444556554322334416"
+    bench2_string = "202123031114445565543223344"
+    bench3_string = "2021230311144455655432"
+    bench4_string = "33333321544124"
+    bench5_string = "333333215441"
+    bench6_string = "3333332154"
+
+    def __init__(self, table_size=16777259, policy='always', book=None, canonical=False, stats=False, table_file=None,
+                 ordering_model=None, ordering_depth=2, table_buffer=None):
         self.width = 7 #board's dimensions
         self.height = 6
         
@@ -21,38 +267,34 @@ class solver:
         self.bottom_masks = [0x1, 0x80 , 0x4000,  0x200000,  0x10000000,   0x800000000,   0x40000000000]
         
         #hash table properties and initialization
-        self.table_size = 15485867 #8388593
-        self.hash_keys = np.zeros(self.table_size, dtype='uint64')
-        self.hash_vals = np.zeros(self.table_size, dtype='int')
-        self.hash_moves = np.zeros(self.table_size, dtype='uint8')
-        
-        #Benchmarks, from easiest to hardest
-        self.bench0_string = "2021230311144455655432233441660"
-        self.bench1_string = "20212303111444556554322334416"
-        self.bench2_string = "202123031114445565543223344"
-        self.bench3_string = "2021230311144455655432"
-        self.bench4_string = "33333321544124"
-        self.bench5_string = "333333215441"      
-        self.bench6_string = "3333332154"
+        self.table_size = table_size #16777259 (5 byte slots), 8388593 (6 byte slots)
+        self.table = transposition_table(table_size, policy, table_file, buffer=table_buffer)
+        self.book = book
+        self.canonical = canonical
+        self.stats = search_stats() if stats else None
+        self.ordering = move_policy(ordering_model, ordering_depth) if ordering_model else None
+        self.sort_buffer = np.zeros((43, 2, self.width), dtype=np.int64) #per ply [moves, scores] scratch rows for move ordering
         
+    def stats_counters(self):
+        """ the counters array passed to the compiled search, or None when statistics are off """
+        return self.stats.counters if self.stats is not None else None
+
+    def guide(self, n_moves):
+        """ the network ordering passed to the compiled search of a position with n_moves moves played, or None without one """
+        return self.ordering.guide(n_moves) if self.ordering is not None else None
+
     ''' Calls negamaxa with iterative deepening and null window search: start with a min/max window and then narrow it down '''
     def iterative_eval(self, current_pos, mask, n_moves):
-        min_val = -( 42 - n_moves ) // 2
-        max_val =  ( 43 - n_moves ) // 2
-        while (min_val < max_val):
-            med_val = (min_val + max_val) // 2 #I don't really understand those 4 lines of code. roughly, we are picking 'med_val' between max_val and min_val
-            if (med_val <= 0 and min_val//2 < med_val):
-                med_val = min_val//2
-            elif (med_val >= 0 and max_val//2 > med_val):
-                med_val = max_val//2
-            
-            r = self.negamax(current_pos, mask, n_moves, med_val, med_val+1)
-            if(r <= med_val):
-                max_val = r
-            else:
-                min_val = r
-            
-        return min_val
+        if self.book is not None:
+            book_entry = self.book.lookup(current_pos, mask)
+            if book_entry is not None:
+                return book_entry[0]
+        if self.stats is None:
+            return iterative_eval_kernel(current_pos, mask, n_moves, self.table.keys, self.table.infos, self.table.policy, self.sort_buffer, self.canonical, self.guide(n_moves), None)
+        iterations = self.stats.counters[stat_iterations]
+        score = iterative_eval_kernel(current_pos, mask, n_moves, self.table.keys, self.table.infos, self.table.policy, self.sort_buffer, self.canonical, self.guide(n_moves), self.stats.counters)
+        self.stats.iterations_per_eval.append(int(self.stats.counters[stat_iterations] - iterations))
+        return score
     
     def solve(self, current_pos, mask, n_moves):
         scores_array = []
@@ -85,67 +327,24 @@ class solver:
         then calls negamax on each of those games, which fills the hash tables
         it may be a better idea to set the terminating condition as number of values in training array
     '''
-    def create_training_data(self, n_games, n_random_moves):
+    def create_training_data(self, n_games, n_random_moves, rng=None):
+        random_boards = C4_batch_state(n_games)  #create all random boards at once. rng: optional numpy Generator, for reproducible boards
+        random_boards.random_boards(n_random_moves, rng)
         for game_counter in range(n_games):
-            rand_pos = C4_state()  #create random board
-            rand_pos.random_board(n_random_moves)
-            self.iterative_eval(rand_pos.current_pos, rand_pos.mask, rand_pos.n_moves)  # plays game, by solving the position for its score
+            current_pos = int(random_boards.current_pos[game_counter])
+            mask = int(random_boards.mask[game_counter])
+            self.iterative_eval(current_pos, mask, int(random_boards.n_moves[game_counter]))  # plays game, by solving the position for its score
             print ("played one game")
 
     def play(self,pos, mask, move):
-        pos ^= mask
-        mask |= (mask + self.bottom_masks[move] )
-        return pos,mask
+        return play_move(pos, mask, move)
 
     """
     Alpha represents the best score guaranteed for the current player
     Beta represents the worst score that the opponent can force current player into
     
     If alpha exceeds beta, search terminates because the opponent can force the game to a score of beta
+    abort: optional 1-element array that stops the search once it is set (see negamax_kernel)
     """
-    def negamax(self,current_pos, mask, n_moves, alpha, beta):
-        if( n_moves == 42): # check for draw. if so, return 0
-            return 0
-            
-        if can_win_next(current_pos, mask): #if we end the game here, then we know the score. return score.
-            return ( ( 43 - n_moves ) ) // 2 #integer division by 2 
-    
-    
-        # GET UPPER BOUND OF SCORE. USE TO UPDATE BETA
-        max_score = (41 - n_moves)//2  #Get upper bound of score
-        highscore = -1 * max_score
-        best_move = 0
-        
-        key = current_pos + mask #this operation produces a unique key for each board
-        index = key%self.table_size
-        looked_up_key = self.hash_keys[index]
-        if (looked_up_key == key):
-            max_score = self.hash_vals[index]
-            
-        if (beta > max_score):
-            beta = max_score # no need to keep beta above maximum
-            if alpha>=beta:
-                return beta #terminate if [alpha;beta] is empty
-           
-        for move in [3,2,4,1,5,0,6]:
-            if mask & self.top_masks[move] != 0: #if can't play (move), skip
-                continue
-            new_pos, new_mask = self.play(current_pos, mask, move)
-            new_n = n_moves + 1
-            score = - self.negamax( new_pos, new_mask, new_n, -beta, -alpha ) 
-            
-            if score > highscore:
-                best_move = move
-                highscore = score
-            
-            if score>=beta:
-                return score  #PRUNE WHEN WE FIND A MOVE BETTER THAN SCORE THAT OPPONENT CAN FORCE US INTO
-                
-            if score>alpha:
-                alpha = score  #ONLY TRACK SCORES BETTER THAN THE BEST SO FAR
-            
-        self.hash_keys[index] = key #once we evaluated a position, we keep its score in the transposition table 
-        self.hash_vals[index] = alpha
-        self.hash_moves[index] = best_move
-        return alpha
-
+    def negamax(self,current_pos, mask, n_moves, alpha, beta, abort=None):
+        return negamax_kernel(current_pos, mask, n_moves, alpha, beta, self.table.keys, self.table.infos, self.table.policy, self.sort_buffer, self.canonical, self.guide(n_moves), self.stats_counters(), abort)
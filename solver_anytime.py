@@ -0,0 +1,134 @@
+"""
+Anytime search for the engine: iterative deepening of a depth-limited negamax, stopped by a deadline.
+
+Every iteration searches the root moves one ply deeper than the last, and scores the positions at the horizon with a heuristic:
+the number of free spots where the player to move would complete an alignment, minus the same count for the opponent.
+Wins and losses found before the horizon are scored like the solver does, scaled by win_scale, so they always beat the heuristic.
+
+The deadline is checked in Python between iterations. An iteration can take much longer than the one before,
+so it also gets a node budget, from the time that is left and the measured speed of the search.
+The speed estimate follows slower measurements at once and faster ones slowly, so that the budget rather stops early than late.
+An iteration that runs out of nodes is thrown away, and the best move of the last complete one is played.
+The search stops early when its result is exact: a win or loss was proven, or the horizon is past the end of the game.
+"""
+
+import time
+import numpy as np
+from numba import jit
+from C4_position import width, height, can_win_next, non_losing_moves, winning_positions, popcount, top_masks
+from solver import play_move, sort_moves_kernel, move_order
+
+win_scale = 100 #heuristic scores are smaller than this, scores of won and lost positions are multiples of it
+no_score = 1 << 30
+counter_nodes = 0
+counter_aborted = 1
+budget_margin = 0.8 #share of the time left that the node budget is computed for, since the speed of the search varies
+speed_rise = 0.1 #share of a faster speed measurement taken into the estimate
+
+
+""" difference between the threats of the player to move and those of the opponent """
+@jit(nopython=True, cache=True)
+def threat_heuristic(current_pos, mask):
+    return popcount(winning_positions(current_pos, mask)) - popcount(winning_positions(current_pos ^ mask, mask))
+
+""" negamax cut at 'depth' plies. counters[counter_aborted] is set, and the result is meaningless, once max_nodes are searched """
+@jit(nopython=True, cache=True)
+def limited_negamax_kernel(current_pos, mask, n_moves, depth, alpha, beta, sort_buffer, counters, max_nodes):
+    counters[counter_nodes] += 1
+    if counters[counter_nodes] > max_nodes:
+        counters[counter_aborted] = 1
+        return 0
+    if n_moves == 42:
+        return 0
+    if can_win_next(current_pos, mask):
+        return ((43 - n_moves) // 2) * win_scale
+    next_moves = non_losing_moves(current_pos, mask)
+    if next_moves == 0:
+        return -((42 - n_moves) // 2) * win_scale
+    if depth == 0:
+        return threat_heuristic(current_pos, mask)
+
+    sort_moves = sort_buffer[n_moves, 0]
+    n_sorted = sort_moves_kernel(current_pos, mask, next_moves, sort_moves, sort_buffer[n_moves, 1])
+    for i in range(n_sorted):
+        new_pos, new_mask = play_move(current_pos, mask, sort_moves[i])
+        score = -limited_negamax_kernel(new_pos, new_mask, n_moves + 1, depth - 1, -beta, -alpha, sort_buffer, counters, max_nodes)
+        if counters[counter_aborted]:
+            return 0
+        if score >= beta:
+            return score
+        if score > alpha:
+            alpha = score
+    return alpha
+
+""" searches root_moves in their order to 'depth' plies. returns (best move, its score), or (-1, 0) if the node budget ran out """
+@jit(nopython=True, cache=True)
+def root_search_kernel(current_pos, mask, n_moves, depth, root_moves, sort_buffer, counters, max_nodes):
+    alpha = -no_score
+    best_move = root_moves[0]
+    for move in root_moves:
+        new_pos, new_mask = play_move(current_pos, mask, move)
+        score = -limited_negamax_kernel(new_pos, new_mask, n_moves + 1, depth - 1, -no_score, -alpha, sort_buffer, counters, max_nodes)
+        if counters[counter_aborted]:
+            return -1, 0
+        if score > alpha:
+            alpha = score
+            best_move = move
+    return best_move, alpha
+
+
+class anytime_search:
+    """
+    nodes_per_second: starting guess of the search speed, used for the node budget until the first iteration has been timed
+    """
+    def __init__(self, nodes_per_second=1e6):
+        self.sort_buffer = np.zeros((43, 2, width), dtype=np.int64)
+        self.counters = np.zeros(2, dtype=np.int64)
+        self.nodes_per_second = nodes_per_second
+        self.search(0, 0, 0, 1000, max_depth=1) #compile now, so the first timed move doesn't pay for it
+
+    def update_speed(self, nodes_per_second):
+        """ a slower measurement is taken at once, a faster one only a little: an overestimate makes the budget overrun the deadline """
+        if nodes_per_second < self.nodes_per_second:
+            self.nodes_per_second = nodes_per_second
+        else:
+            self.nodes_per_second += speed_rise * (nodes_per_second - self.nodes_per_second)
+
+    def root_moves(self, current_pos, mask, root_order):
+        """ the moves worth searching, in root_order: the non-losing ones, or every legal move if they all lose """
+        next_moves = non_losing_moves(current_pos, mask)
+        moves = [move for move in root_order if next_moves & (((1 << height) - 1) << ((height + 1) * move))]
+        if not moves:
+            moves = [move for move in root_order if mask & top_masks[move] == 0]
+        return moves
+
+    def search(self, current_pos, mask, n_moves, time_ms, root_order=move_order, max_depth=42):
+        """
+        returns (best move, score, depth of the last complete iteration, exact) for the position, within time_ms milliseconds.
+        root_order: order in which the first iteration tries the moves, e.g. the network's ranking. Later iterations start with the last best move
+        The position must not be over, and the player to move must not have a winning move (the engine plays those at once)
+        """
+        deadline = time.perf_counter() + time_ms / 1000
+        moves = self.root_moves(current_pos, mask, root_order)
+        best_move, best_score, best_depth = moves[0], 0, 0
+        if len(moves) == 1:
+            return best_move, best_score, best_depth, False
+        for depth in range(1, min(max_depth, 42 - n_moves) + 1):
+            start = time.perf_counter()
+            if start >= deadline:
+                break
+            self.counters.fill(0)
+            move, score = root_search_kernel(current_pos, mask, n_moves, depth, np.array(moves, dtype=np.int64),
+                                             self.sort_buffer, self.counters, int(budget_margin * (deadline - start) * self.nodes_per_second))
+            elapsed = time.perf_counter() - start
+            if self.counters[counter_aborted]:
+                break
+            if elapsed > 0.001 and self.counters[counter_nodes] > 1000: #too short to time
+                self.update_speed(self.counters[counter_nodes] / elapsed)
+            best_move, best_score, best_depth = move, score, depth
+            if abs(score) >= win_scale: #proven win or loss, deeper searches can't change it
+                break
+            moves.remove(move)
+            moves.insert(0, move)
+        exact = abs(best_score) >= win_scale or best_depth >= 42 - n_moves
+        return best_move, best_score, best_depth, exact
@@ -0,0 +1,200 @@
+"""
+Solver benchmark: times the solver on the bench ladder (bench0_string ... bench6_string) and on random positions,
+checks every result against known scores (bench ladder and the default random positions), and compares the run with a saved baseline.
+
+For every position it reports wall time (best and mean of the repeats), nodes searched, nodes/sec and table hit rate.
+Each repeat starts from an empty transposition table, so repeats are comparable.
+
+Usage examples:
+    python solver_bench.py --json baseline.json
+    python solver_bench.py --random-depths 16 20 --random-count 10 --baseline baseline.json --threshold 0.10
+    python solver_bench.py --ordering-model project_ANN2.npz --baseline baseline.json (does network move ordering pay for itself?)
+    python solver_bench.py --bench bench4_string bench5_string bench6_string --workers 8 (parallel solve, see solver_parallel)
+
+Exits with status 1 if a score is wrong, or if a position got slower than the baseline by more than the threshold.
+"""
+
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import solver
+import solver_parallel
+from C4_position import C4_state
+from C4_batch import C4_batch_state
+
+#scores of every column (X: column is full) for the bench ladder, from the pure python solver
+known_scores = {
+    'bench0_string': [-5, -5, -5, 0, 'X', -5, -5],
+    'bench1_string': [0, 0, 0, 0, 'X', -4, 0],
+    'bench2_string': [-1, 0, -2, -1, 'X', -2, -2],
+    'bench3_string': [-7, -8, 0, -7, -8, -8, -7],
+    'bench4_string': [-2, -11, -2, 'X', 1, -2, -2],
+    'bench5_string': [-1, 1, 1, 'X', 0, -2, -2],
+    'bench6_string': [-2, -2, -2, 'X', 1, -2, -4],
+}
+
+#scores of random positions, by (current_pos, mask), from the pure python solver. these are the boards of
+#--random-depths 16 20 24 --random-count 10 --seed 0 (the defaults), so a default run checks every position it solves
+known_random_scores = {
+    (0x40010a0800b, 0x1c0011e0c18f): [12, 13, 12, 12, 12, 13, 12], #random_d16_0
+    (0xc0e0c001, 0xc08f1e0c083): [8, 9, 11, 8, 10, 10, 11], #random_d16_1
+    (0x1000068183, 0x180067c787): [-13, -13, -13, -13, -13, -13, -13], #random_d16_2
+    (0xc5010204001, 0xc783021c183): [-13, -13, -13, 1, -13, -13, -13], #random_d16_3
+    (0x4080120c003, 0x3c1801e0c087): [-13, -13, -13, -13, 13, -13, -4], #random_d16_4
+    (0xc0060010105, 0xc08f001c387): [-13, -13, -13, 2, -13, -13, -13], #random_d16_5
+    (0x9d00001c000, 0x7df80021c080): [-13, -13, 13, -13, -13, 'X', -13], #random_d16_6
+    (0xc9000204005, 0xdf810604087): [-5, -2, 2, -4, -9, 'X', -2], #random_d16_7
+    (0xc080001800b, 0xc183021c03f): ['X', 2, -13, -13, -13, -13, -13], #random_d16_8
+    (0x400e000c014, 0xc00f001c0bf): ['X', 4, 8, 8, 13, 8, 4], #random_d16_9
+    (0x43010208384, 0x43870e1c787): [11, -11, -11, -11, -11, -11, -11], #random_d20_0
+    (0x114060808d, 0x439f0e0c18f): [10, 11, -11, 8, 1, 5, 2], #random_d20_1
+    (0x2130e18080, 0x7bf1e1c083): [-11, 11, -11, -11, 'X', -11, -11], #random_d20_2
+    (0x1003414283, 0x7817e1c387): [-11, -11, 11, 'X', -11, -11, 9], #random_d20_3
+    (0x18300101ac, 0x4787001c3bf): ['X', -3, -3, -11, -3, -3, -3], #random_d20_4
+    (0x1028200b4081, 0x1c38702fc183): [-11, -11, 'X', 0, -11, -11, -11], #random_d20_5
+    (0x43810038081, 0x3cf810e3c083): [-11, -11, 11, -11, -11, -11, -11], #random_d20_6
+    (0x15010c00185, 0x5f831e04387): [-4, -2, -4, -2, -4, 'X', -4], #random_d20_7
+    (0x140820600292, 0x1c19f060039f): [-11, -11, -11, -11, -4, -11, -11], #random_d20_8
+    (0x2c5003400005, 0x7cf803e0008f): [9, 9, 9, 9, 10, 9, 9], #random_d20_9
+    (0x8d015604300, 0x1cf837e0c387): [-9, -9, -9, 'X', 9, -9, -9], #random_d24_0
+    (0x4384260008e, 0x4f9f3e0039f): [-8, -8, -9, -8, -8, -8, -8], #random_d24_1
+    (0x1a02220c303, 0x5f837e1c387): [9, -9, 9, 'X', -9, 'X', -9], #random_d24_2
+    (0x10283061010b, 0x3c3830e3c39f): [8, 9, 8, 9, -9, 8, 8], #random_d24_3
+    (0x740800614902, 0x7c3870e1cf83): [-9, -9, -9, -9, 7, -9, 9], #random_d24_4
+    (0x18703000c086, 0x3cf87060c39f): [-8, -8, -1, -1, -8, -8, -8], #random_d24_5
+    (0x440308002b7, 0x478f0e1c3bf): ['X', -9, -8, -9, -9, -9, -9], #random_d24_6
+    (0x10683060800d, 0x1df870e1c18f): [-9, 9, -9, -9, -9, 'X', 9], #random_d24_7
+    (0x2ac0c4c101, 0x7bf1e7c781): [9, 8, 8, 8, 'X', 9, 8], #random_d24_8
+    (0x54180120c601, 0xfc1837e0cf81): [-7, -7, -9, 'X', 9, 8, 'X'], #random_d24_9
+}
+
+
+def bench_positions(names):
+    """ returns [(name, current_pos, mask, n_moves, known scores)] for bench strings of solver.solver """
+    positions = []
+    for name in names:
+        board = C4_state()
+        board.play_string(getattr(solver.solver, name))
+        positions.append((name, board.current_pos, board.mask, board.n_moves, known_scores.get(name)))
+    return positions
+
+def random_positions(depths, count, seed):
+    """ returns count random, non-terminal positions for each depth. the same seed gives the same positions. known scores are checked """
+    positions = []
+    for depth in depths:
+        boards = C4_batch_state(count)
+        boards.random_boards(depth, np.random.default_rng([seed, depth]))
+        for i in range(count):
+            current_pos, mask = int(boards.current_pos[i]), int(boards.mask[i])
+            positions.append(("random_d%d_%d" % (depth, i), current_pos, mask, depth, known_random_scores.get((current_pos, mask))))
+    return positions
+
+def run_position(bench_solver, current_pos, mask, n_moves, repeat):
+    """ solves a position 'repeat' times from an empty table. returns (scores, times, stats of the last run) """
+    times = []
+    for run in range(repeat):
+        bench_solver.table.reset()
+        bench_solver.stats.reset()
+        if bench_solver.ordering is not None:
+            bench_solver.ordering.reset()
+        start = time.perf_counter()
+        scores = bench_solver.solve(current_pos, mask, n_moves)
+        times.append(time.perf_counter() - start)
+    return scores, times, bench_solver.stats.as_dict()
+
+def run_benchmark(positions, bench_solver, repeat, verbose=True):
+    results = []
+    for name, current_pos, mask, n_moves, expected in positions:
+        scores, times, stats = run_position(bench_solver, current_pos, mask, n_moves, repeat)
+        result = {
+            'name': name, 'current_pos': current_pos, 'mask': mask, 'n_moves': n_moves,
+            'scores': scores, 'expected': expected, 'ok': expected is None or scores == expected,
+            'time_best': min(times), 'time_mean': sum(times) / len(times),
+            'nodes': stats['nodes'], 'nodes_per_sec': stats['nodes'] / min(times) if min(times) > 0 else 0.0,
+            'hit_rate': stats['hit_rate'], 'policy_calls': stats['policy_calls'],
+        }
+        results.append(result)
+        if verbose:
+            print("%-16s %9.4fs %12d nodes %12.0f nodes/s  hit rate %5.3f  %s" % (
+                name, result['time_best'], result['nodes'], result['nodes_per_sec'], result['hit_rate'],
+                "ok" if result['ok'] else "WRONG SCORES %s, expected %s" % (scores, expected)))
+    return results
+
+def compare_with_baseline(results, baseline, threshold, min_time=0.01):
+    """
+    returns a list of problems: wrong scores compared with the baseline, and positions slower than baseline * (1 + threshold).
+    positions that took less than min_time seconds in the baseline are too noisy to time, only their scores are compared
+    """
+    baseline_results = {result['name']: result for result in baseline['results']}
+    problems = []
+    for result in results:
+        old = baseline_results.get(result['name'])
+        if old is None:
+            continue
+        if old['scores'] != result['scores']:
+            problems.append("%s: scores %s, baseline had %s" % (result['name'], result['scores'], old['scores']))
+        if old['time_best'] >= min_time and result['time_best'] > old['time_best'] * (1 + threshold):
+            problems.append("%s: %.4fs, baseline %.4fs (+%.1f%%)" % (
+                result['name'], result['time_best'], old['time_best'], 100 * (result['time_best'] / old['time_best'] - 1)))
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Connect Four solver")
+    parser.add_argument('--bench', nargs='*', default=sorted(known_scores), help="bench strings to run (default: all)")
+    parser.add_argument('--random-depths', nargs='*', type=int, default=[16, 20, 24], help="also solve random positions with these numbers of moves")
+    parser.add_argument('--random-count', type=int, default=10, help="random positions per depth")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--table-size', type=int, default=16777259)
+    parser.add_argument('--policy', default='always')
+    parser.add_argument('--canonical', action='store_true')
+    parser.add_argument('--ordering-model', help="network weights (.npz) used to order moves near the root")
+    parser.add_argument('--ordering-depth', type=int, default=2, help="plies ordered by the network")
+    parser.add_argument('--workers', type=int, help="solve every position on this many processes sharing one table (solver_parallel.parallel_solver)")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--baseline', help="results file of an earlier run to compare with")
+    parser.add_argument('--threshold', type=float, default=0.10, help="allowed slowdown against the baseline, as a fraction")
+    parser.add_argument('--min-time', type=float, default=0.01, help="don't compare times of positions faster than this (seconds)")
+    args = parser.parse_args(argv)
+
+    positions = bench_positions(args.bench) + random_positions(args.random_depths, args.random_count, args.seed)
+    if args.workers:
+        bench_solver = solver_parallel.parallel_solver(args.workers, args.table_size, args.policy, canonical=args.canonical, stats=True,
+                                                       ordering_model=args.ordering_model, ordering_depth=args.ordering_depth)
+    else:
+        bench_solver = solver.solver(args.table_size, args.policy, canonical=args.canonical, stats=True,
+                                     ordering_model=args.ordering_model, ordering_depth=args.ordering_depth)
+    bench_solver.solve(*bench_positions(['bench0_string'])[0][1:4]) #compile the search before timing it
+
+    results = run_benchmark(positions, bench_solver, args.repeat)
+    total_time = sum(result['time_best'] for result in results)
+    total_nodes = sum(result['nodes'] for result in results)
+    report = {
+        'config': {'table_size': args.table_size, 'policy': args.policy, 'canonical': args.canonical,
+                   'ordering_model': args.ordering_model, 'ordering_depth': args.ordering_depth,
+                   'repeat': args.repeat, 'seed': args.seed, 'workers': args.workers},
+        'results': results,
+        'total': {'time_best': total_time, 'nodes': total_nodes, 'nodes_per_sec': total_nodes / total_time if total_time > 0 else 0.0},
+    }
+    print("total %9.4fs %12d nodes %12.0f nodes/s" % (total_time, total_nodes, report['total']['nodes_per_sec']))
+    if args.workers:
+        bench_solver.close()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    problems = ["%s: wrong scores %s, expected %s" % (result['name'], result['scores'], result['expected'])
+                for result in results if not result['ok']]
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems += compare_with_baseline(results, json.load(f), args.threshold, args.min_time)
+    for problem in problems:
+        print("FAIL", problem)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -12,19 +12,17 @@ Uses the solver to produce a training set. Training set contains keys, values an
         Number which is the optimal move that maximizes value for current player
 
 """
-import solver
-import numpy as np
+import solver_parallel
 
 n_games = 50 #number of games to be solved to produce the training set
 n_random_moves = 16 #Number of moves played randomly before solver is invoked
+n_workers = None #number of worker processes. None uses one per cpu
+seed = 0 #worker i seeds its random boards with seed + i, so runs are reproducible
+out_file = "data/test_set.npz"
+table_dir = None #directory for the workers' transposition tables, e.g. "data/tables". a restarted run resumes from them
 
-test_solver = solver.solver()
-test_solver.create_training_data( n_games, n_random_moves )
-
-# change hash table structure to 3 arrays of keys, values and moves by removing zeros in the hash table
-good_ind = np.nonzero(test_solver.hash_keys)
-hash_keys = test_solver.hash_keys [ good_ind ]
-hash_vals = test_solver.hash_vals [ good_ind ]
-hash_moves = test_solver.hash_moves[good_ind ]
-
-#np.savez( "test_set", hash_keys = hash_keys, hash_vals = hash_vals, hash_moves = hash_moves )
\ No newline at end of file
+# each worker solves its share of the games in its own hash table. The tables are then merged, with duplicate keys removed,
+# into 3 arrays of keys, values and moves, and saved to out_file
+if __name__ == "__main__": #guard needed by multiprocessing on platforms that spawn workers
+    n_positions = solver_parallel.create_training_data_parallel( n_games, n_random_moves, out_file, n_workers, seed, table_dir=table_dir )
+    print ("saved", n_positions, "positions to", out_file)
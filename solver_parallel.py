@@ -0,0 +1,238 @@
+"""
+Multi-process solving: training data generation, and the solve of one hard position.
+
+Splits the random games of solver.create_training_data across a pool of worker processes.
+Every worker owns its own solver and transposition table, and draws its random boards from a NumPy generator with its own seed,
+so a run with the same base seed and number of workers produces the same data set.
+Workers store mirrored positions under one canonical key (the smaller of key and its mirror image),
+and the merged data set keeps canonical keys only, with the moves given for the canonical orientation.
+At the end the filled slots of all tables are merged, duplicated keys are removed,
+and the result is saved to a .npz file with the same 'hash_keys', 'hash_vals' and 'hash_moves' arrays as data/training_set*.npz
+
+With a table_dir, worker i keeps its transposition table in table_dir/worker<i>.table. A run that was stopped
+can be started again with the same arguments: the workers redraw the same boards, and everything already solved is a table hit
+
+parallel_solver solves one position on a pool of processes that share one transposition table in shared memory.
+solver.solve finds the score of every root move with a sequence of null window searches (probes), each narrowing the
+window [min, max] of the score. Here the probes of all root moves are handed out together: every idle worker gets
+a probe of the move whose score is least known, at a value no other worker is probing, so that there is work for more
+workers than there are moves. Each probe's result narrows the window of its move, whichever order they come back in,
+and a move is done when its window is closed. A running probe whose value falls out of its move's window was overtaken:
+its flag in a shared array is set, and the search checks it at every node and gives up, so the worker takes the next probe.
+The workers never wait for each other:
+they read and write the shared table without locks, and torn slots are rejected by the key check (see solver_table).
+Every stored score is a true bound however the searches interleave, so the scores are the same as solver.solve's,
+only the number of nodes searched changes from run to run.
+
+    with parallel_solver(n_workers=8) as analysis:
+        scores = analysis.solve(current_pos, mask, n_moves)
+"""
+
+import os
+import queue
+import multiprocessing
+import numpy as np
+import solver
+from solver_table import slot_dtype, transposition_table
+from C4_position import alignment, top_masks, width
+from C4_batch import canonical_keys, canonical_moves
+
+
+def solve_random_games(worker_args):
+    """ worker: solves n_games random boards with its own solver and returns the filled table slots """
+    n_games, n_random_moves, seed, table_size, table_file = worker_args
+    worker_solver = solver.solver(table_size, canonical=True, table_file=table_file)
+    worker_solver.create_training_data(n_games, n_random_moves, np.random.default_rng(seed))
+    worker_solver.table.flush()
+    return worker_solver.table.entries()
+
+def merge_entries(results):
+    """
+    concatenates (keys, values, moves) from several tables and keeps one entry per canonical key.
+    Stored values are upper bounds, so the smallest, tightest one is kept with its move, as in solver_table.merge_tables
+    """
+    hash_keys = np.concatenate([keys for keys, vals, moves in results])
+    hash_vals = np.concatenate([vals for keys, vals, moves in results])
+    hash_moves = np.concatenate([moves for keys, vals, moves in results])
+    hash_keys, mirrored = canonical_keys(hash_keys) #no-op for canonical tables, folds mirrored pairs of other tables
+    hash_moves = canonical_moves(hash_moves, mirrored)
+    order = np.lexsort((hash_vals, hash_keys)) #by key, smallest bound first
+    hash_keys, hash_vals, hash_moves = hash_keys[order], hash_vals[order], hash_moves[order]
+    first = np.ones(len(hash_keys), dtype=bool)
+    first[1:] = hash_keys[1:] != hash_keys[:-1]
+    return hash_keys[first], hash_vals[first], hash_moves[first]
+
+def create_training_data_parallel(n_games, n_random_moves, out_file, n_workers=None, seed=0, table_size=16777259, table_dir=None):
+    """
+    Solves n_games random boards on n_workers processes (default: one per cpu) and saves the merged tables to out_file.
+    Worker i uses seed + i. Returns the number of unique positions saved
+    table_dir: optional directory for the workers' table files, to resume an interrupted run
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    n_workers = max(1, min(n_workers, n_games))
+    games_per_worker = [n_games // n_workers + (i < n_games % n_workers) for i in range(n_workers)]
+    if table_dir is not None:
+        os.makedirs(table_dir, exist_ok=True)
+    table_files = [os.path.join(table_dir, "worker%d.table" % i) if table_dir is not None else None for i in range(n_workers)]
+    worker_args = [(games_per_worker[i], n_random_moves, seed + i, table_size, table_files[i]) for i in range(n_workers)]
+
+    with multiprocessing.Pool(n_workers) as pool:
+        results = pool.map(solve_random_games, worker_args)
+
+    hash_keys, hash_vals, hash_moves = merge_entries(results)
+    np.savez(out_file, hash_keys=hash_keys, hash_vals=hash_vals, hash_moves=hash_moves)
+    return len(hash_keys)
+
+
+#solver of a parallel_solver's worker process, on the shared table, and the shared abort flags of the running probes. built once by init_solve_worker
+worker_solver = None
+worker_aborts = None
+
+def init_solve_worker(table_buffer, abort_buffer, table_size, policy, canonical, stats, ordering_model, ordering_depth):
+    global worker_solver, worker_aborts
+    worker_solver = solver.solver(table_size, policy, canonical=canonical, stats=stats, ordering_model=ordering_model,
+                                  ordering_depth=ordering_depth, table_buffer=table_buffer)
+    worker_aborts = np.frombuffer(abort_buffer, dtype=np.int8)
+    worker_solver.negamax(0, 0, 42, 0, 1, np.zeros(1, dtype=np.int8)) #compiles the search now. a full board returns at once, without touching the table
+
+def probe_task(task):
+    """
+    worker: null window search of a position at 'value', stopped once the probe's abort flag is set.
+    returns (move, value, result, aborted, search counters or None). The result of an aborted probe is meaningless
+    """
+    move, current_pos, mask, n_moves, value, slot = task
+    if worker_solver.stats is not None:
+        worker_solver.stats.reset()
+    abort = worker_aborts[slot:slot + 1]
+    result = worker_solver.negamax(current_pos, mask, n_moves, value, value + 1, abort)
+    return move, value, int(result), bool(abort[0]), worker_solver.stats.counters.copy() if worker_solver.stats is not None else None
+
+
+class root_window:
+    """ what is known of the score of one root move: min_val <= score <= max_val, as in solver.iterative_eval_kernel """
+    def __init__(self, move, current_pos, mask, n_moves):
+        self.move = move
+        self.position = (current_pos, mask, n_moves)
+        self.min_val = -( 42 - n_moves ) // 2
+        self.max_val = ( 43 - n_moves ) // 2
+        self.probing = {} #abort slots of the probes running now, by value
+        self.n_probes = 0
+
+    def done(self):
+        return self.min_val >= self.max_val
+
+    def next_value(self):
+        """ the value to probe next: the one iterative_eval would pick, or the closest one nobody is probing. None if there is none """
+        med_val = (self.min_val + self.max_val) // 2
+        if (med_val <= 0 and self.min_val//2 < med_val):
+            med_val = self.min_val//2
+        elif (med_val >= 0 and self.max_val//2 > med_val):
+            med_val = self.max_val//2
+        free = [value for value in range(self.min_val, self.max_val) if value not in self.probing]
+        return min(free, key=lambda value: (abs(value - med_val), value)) if free else None
+
+    def update(self, value, result):
+        """ a probe at 'value' returned 'result'. results of probes that were overtaken by others are still true bounds """
+        if result <= value:
+            self.max_val = min(self.max_val, result)
+        else:
+            self.min_val = max(self.min_val, result)
+
+    def overtaken(self):
+        """ abort slots of the running probes whose value is out of the window: their result can't tell anything new """
+        return [slot for value, slot in self.probing.items() if not self.min_val <= value < self.max_val]
+
+
+class parallel_solver:
+    """
+    solve() with the same scores as solver.solver.solve, on n_workers processes (default: one per cpu) sharing one table.
+    table_size, policy, canonical, ordering_model, ordering_depth: as for solver.solver. The table lives as long as the parallel_solver,
+        so later solves start with everything the earlier ones found. 5 or 6 bytes per slot (see solver_table), allocated once for all workers
+    book: optional C4_book.opening_book. Root moves to book positions are not searched
+    stats: if True, self.stats adds up the search counters of all workers (null_window_iterations counts probes, aborted ones too)
+    n_aborted: probes of the last solve that were given up because others overtook them
+    Call close() (or use it as a context manager) to stop the workers
+    """
+    def __init__(self, n_workers=None, table_size=16777259, policy='always', book=None, canonical=False, stats=False, ordering_model=None,
+                 ordering_depth=2):
+        self.n_workers = n_workers if n_workers is not None else os.cpu_count()
+        self.table_buffer = multiprocessing.RawArray('b', table_size * slot_dtype(table_size).itemsize) #zeroed: every slot empty
+        self.table = transposition_table(table_size, policy, buffer=self.table_buffer) #the same slots, seen from this process
+        self.abort_buffer = multiprocessing.RawArray('b', self.n_workers) #one flag per running probe
+        self.aborts = np.frombuffer(self.abort_buffer, dtype=np.int8)
+        self.book = book
+        self.stats = solver.search_stats() if stats else None
+        self.ordering = None #the workers' network caches are their own
+        self.pool = multiprocessing.Pool(self.n_workers, initializer=init_solve_worker,
+                                         initargs=(self.table_buffer, self.abort_buffer, table_size, policy, canonical, stats, ordering_model, ordering_depth))
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def solve(self, current_pos, mask, n_moves):
+        """ returns the score of every column, 'X' for full columns, like solver.solver.solve """
+        scores = []
+        windows = []
+        for move in range(width):
+            if mask & top_masks[move] != 0:
+                scores.append('X')
+                continue
+            new_pos, new_mask = solver.play_move(current_pos, mask, move)
+            if alignment(new_pos ^ new_mask):
+                scores.append(( 43 - n_moves ) // 2)
+                continue
+            book_entry = self.book.lookup(new_pos, new_mask) if self.book is not None else None
+            if book_entry is not None:
+                scores.append(-book_entry[0])
+                continue
+            scores.append(None)
+            windows.append(root_window(move, new_pos, new_mask, n_moves + 1))
+        windows.sort(key=lambda window: solver.move_order.index(window.move)) #center first, like the serial search finds its cutoffs
+
+        results = queue.Queue() #filled by the pool's result thread
+        free_slots = list(range(self.n_workers))
+        self.n_aborted = 0
+        while True:
+            while free_slots:
+                open_windows = [window for window in windows if not window.done() and window.next_value() is not None]
+                if not open_windows:
+                    break
+                window = min(open_windows, key=lambda window: (len(window.probing), window.min_val - window.max_val))
+                value = window.next_value()
+                slot = free_slots.pop()
+                self.aborts[slot] = 0
+                window.probing[value] = slot
+                window.n_probes += 1
+                self.pool.apply_async(probe_task, ((window.move, *window.position, value, slot),), callback=results.put, error_callback=results.put)
+            if len(free_slots) == self.n_workers:
+                break
+            result = results.get()
+            if isinstance(result, BaseException):
+                raise result
+            move, value, probe_result, aborted, counters = result
+            window = next(window for window in windows if window.move == move)
+            free_slots.append(window.probing.pop(value))
+            if aborted:
+                self.n_aborted += 1
+            else:
+                window.update(value, probe_result)
+                for slot in window.overtaken():
+                    self.aborts[slot] = 1
+            if self.stats is not None:
+                self.stats.counters += counters
+                self.stats.counters[solver.stat_iterations] += 1
+        #stops once every window is closed and no probe is running. overtaken probes give up at once, so that takes no longer
+
+        for window in windows:
+            scores[window.move] = -window.min_val
+            if self.stats is not None:
+                self.stats.iterations_per_eval.append(window.n_probes)
+        return scores
@@ -0,0 +1,157 @@
+"""
+Move ordering by the move-prediction network, inside the compiled search.
+
+The solver normally tries moves by the number of threats they create, and breaks ties center first.
+With a move_policy, nodes close to the root break the ties by the network's preference instead.
+(Ordering by the network alone searched about a third more nodes on the bench positions with project_ANN2:
+it doesn't see threats, which are what cut the tree.)
+One forward pass scores all the children of a node at once, and the scores are cached by key,
+so a position reached again through a transposition costs no second pass.
+Deeper nodes are too many and too cheap to be worth a forward pass, so they keep the static ordering.
+
+The ordering only changes which moves are searched first, never which moves are searched, so scores are the same as without it.
+
+The forward pass is written out as loops in nopython mode over the weights exported by C4_ANN.export_weights.
+The input bits of a key are only 0 or 1, so the first layer adds up the kernel rows of the set bits instead of a product.
+"""
+
+import numpy as np
+from numba import jit
+from C4_position import height, width, winning_positions, popcount
+
+#activations the compiled forward pass knows. the final softmax is skipped, it doesn't change the order of the scores
+activation_codes = {'linear': 0, 'tanh': 1, 'relu': 2, 'softmax': 3}
+n_input_bits = 56
+empty_cache_key = -1 #not a valid key. 0 is, it's the empty board
+score_scale = 1 << 20 #network outputs are stored as integers in the solver's sort buffer
+threat_scale = 1 << 40 #threat counts come first, the network's scores only decide between equal counts
+
+#positions of the parts of the tuple passed to the search
+guide_kernels = 0
+guide_biases = 1
+guide_activations = 2
+guide_buffer = 3
+guide_cache_keys = 4
+guide_cache_scores = 5
+guide_max_ply = 6
+
+
+""" x = x_in times kernel plus bias, for one dense layer. its own function, so the inner loop is compiled for plain arrays, not tuple items """
+@jit(nopython=True)
+def dense_layer(x_in, kernel, bias, x):
+    n_in, n_units = kernel.shape
+    for unit in range(n_units):
+        x[unit] = bias[unit]
+    for i in range(n_in): #row by row, so the inner loop runs over contiguous kernel entries
+        x_i = x_in[i]
+        for unit in range(n_units):
+            x[unit] += x_i * kernel[i, unit]
+
+""" runs the network from its first-layer sums in buffer[0] (before the activation), and writes the outputs (before a final softmax) into out """
+@jit(nopython=True)
+def dense_layers(kernels, biases, activations, buffer, out):
+    x = buffer[0]
+    n_units = biases[0].shape[0]
+    for layer in range(len(kernels)):
+        if layer > 0:
+            x = buffer[layer % 2]
+            n_units = biases[layer].shape[0]
+            dense_layer(buffer[(layer - 1) % 2], kernels[layer], biases[layer], x)
+        activation = activations[layer]
+        if activation == 1:
+            for unit in range(n_units):
+                x[unit] = np.tanh(x[unit])
+        elif activation == 2:
+            for unit in range(n_units):
+                if x[unit] < 0:
+                    x[unit] = 0
+    for unit in range(n_units):
+        out[unit] = x[unit]
+
+""" writes the network outputs (before a final softmax) for the position 'key' into out """
+@jit(nopython=True)
+def policy_forward(key, kernels, biases, activations, buffer, out):
+    #first layer: network input i is bit (7 - i % 8) of byte i // 8 of the key. add the kernel rows of the inputs that are 1
+    x = buffer[0]
+    kernel = kernels[0]
+    bias = biases[0]
+    n_units = bias.shape[0]
+    for unit in range(n_units):
+        x[unit] = bias[unit]
+    for i in range(n_input_bits):
+        if (key >> (8 * (i // 8) + 7 - i % 8)) & 1:
+            for unit in range(n_units):
+                x[unit] += kernel[i, unit]
+    dense_layers(kernels, biases, activations, buffer, out)
+
+""" returns the cached network outputs of 'key', computing them on a cache miss. second value: True on a cache hit """
+@jit(nopython=True)
+def policy_scores(key, guide):
+    cache_keys = guide[guide_cache_keys]
+    cache_scores = guide[guide_cache_scores]
+    index = key % cache_keys.shape[0]
+    if cache_keys[index] == key:
+        return cache_scores[index], True
+    policy_forward(key, guide[guide_kernels], guide[guide_biases], guide[guide_activations], guide[guide_buffer], cache_scores[index])
+    cache_keys[index] = key
+    return cache_scores[index], False
+
+""" like solver.sort_moves_kernel, with ties broken by the network's scores. returns (number of moves, True on a cache hit) """
+@jit(nopython=True)
+def sort_moves_policy(current_pos, mask, next_moves, sort_moves, sort_scores, guide):
+    scores, cache_hit = policy_scores(current_pos + mask, guide)
+    n_sorted = 0
+    for move in range(width):
+        move_bit = next_moves & (((1 << height) - 1) << ((height + 1) * move))
+        if move_bit == 0:
+            continue
+        score = popcount( winning_positions(current_pos | move_bit, mask | move_bit) ) * threat_scale + np.int64(scores[move] * score_scale)
+        i = n_sorted
+        while i > 0 and sort_scores[i-1] < score:
+            sort_moves[i] = sort_moves[i-1]
+            sort_scores[i] = sort_scores[i-1]
+            i -= 1
+        sort_moves[i] = move
+        sort_scores[i] = score
+        n_sorted += 1
+    return n_sorted, cache_hit
+
+
+def load_weights(weights_file):
+    """ returns (kernels, biases, activation codes) of weights exported by C4_ANN.export_weights, as the compiled forward pass takes them """
+    weights = np.load(weights_file)
+    names = [str(name) for name in weights['activations']]
+    unknown = [name for name in names if name not in activation_codes]
+    if unknown:
+        raise ValueError("%s uses activations %s, the compiled forward pass knows %s" % (weights_file, unknown, sorted(activation_codes)))
+    kernels = tuple(np.ascontiguousarray(weights['kernel%d' % i], dtype=np.float32) for i in range(len(names)))
+    biases = tuple(np.ascontiguousarray(weights['bias%d' % i], dtype=np.float32) for i in range(len(names)))
+    if kernels[0].shape[0] != n_input_bits or biases[-1].shape[0] != width:
+        raise ValueError("%s is not a %d input, %d output network" % (weights_file, n_input_bits, width))
+    return kernels, biases, np.array([activation_codes[name] for name in names], dtype=np.int64)
+
+
+class move_policy:
+    """
+    network weights and score cache for the solver's move ordering
+    weights_file: .npz weights exported by C4_ANN.export_weights (e.g. project_ANN2.npz)
+    depth: number of plies below the searched position that are ordered by the network
+    cache_size: number of cached positions. 28 bytes each
+    """
+    def __init__(self, weights_file, depth=2, cache_size=1 << 18):
+        self.kernels, self.biases, self.activations = load_weights(weights_file)
+        self.buffer = np.zeros((2, max(len(bias) for bias in self.biases)), dtype=np.float32)
+        self.depth = depth
+        self.cache_keys = np.full(cache_size, empty_cache_key, dtype=np.int64)
+        self.cache_scores = np.zeros((cache_size, width), dtype=np.float32)
+
+    def reset(self):
+        self.cache_keys.fill(empty_cache_key)
+
+    def guide(self, n_moves):
+        """ the tuple passed to the compiled search, for a search of a position with n_moves moves played """
+        return (self.kernels, self.biases, self.activations, self.buffer, self.cache_keys, self.cache_scores, n_moves + self.depth)
+
+    def scores(self, key):
+        """ network outputs (before the final softmax) of a position """
+        return policy_scores(int(key), self.guide(0))[0].copy()
@@ -0,0 +1,319 @@
+"""
+Transposition table used by the solver.
+
+Every slot is packed into 5 or 6 bytes instead of the 17 bytes of the old parallel key/value/move arrays.
+The info of an entry takes 15 bits: bits 0-5 score bound, bits 6-8 best move, bits 9-14 number of moves played (depth).
+    - tables of at least 2^24 slots (the default size), 40 bits (5 bytes, 3.4x smaller):
+        key  (32 bits): the lower 25 bits of the position key above the top 7 bits of the info, XORed with the low byte of the info
+        info (8 bits): the low byte of the info
+    - smaller tables, 48 bits (6 bytes, 2.8x smaller):
+        key  (32 bits): the lower 32 bits of the position key, XORed with the info
+        info (16 bits): the info
+
+Only part of the key is stored. Since index = key % table_size, the slot index already tells us key modulo the table size.
+Together with key modulo 2^25 (or 2^32) the Chinese remainder theorem gives back the full key, as long as table_size is odd
+and table_size * 2^25 (or 2^32) is larger than the largest key (49 bits). So the partial key check is still exact,
+and the bigger the table, the fewer key bits a slot needs.
+
+An info field of 0 marks an empty slot, which is why the score is stored with an offset.
+
+The key and the info of a slot are two separate writes, so a search that shares its table with other processes
+(solver_parallel.parallel_solver) can read a slot halfway through another process' store: the key of one entry with the info of another.
+Storing the partial key XORed with the info field makes the key check cover the info as well. A torn slot fails the check like a slot
+of another position and is treated as a miss, so no lock is needed and a search never uses an info that wasn't stored for its position.
+
+A table can live in a file, so that a later process picks up the search where the last one stopped.
+The file is a 64 byte header (magic, format version, number of slots, bytes per slot) followed by the packed slots,
+which are memory-mapped: opening a table reads nothing, and every store goes straight to the file's pages.
+Tables of two runs can be merged offline with merge_tables, or from the command line:
+
+    python solver_table.py out_file in_file1 in_file2 [...]
+"""
+
+import os
+import sys
+import numpy as np
+from numba import jit
+
+small_slot_dtype = np.dtype([('key', np.uint32), ('info', np.uint8)]) #packed, no alignment padding. 5 bytes
+large_slot_dtype = np.dtype([('key', np.uint32), ('info', np.uint16)]) #6 bytes
+word_bits = 32 #bits of a slot's key field
+info_bits = 15
+max_key_bits = 49 #7 columns of 7 bits
+min_table_size = 1 << (max_key_bits - word_bits) #smaller tables can't recover the full key from the partial key
+min_small_slot_size = 1 << (max_key_bits - (word_bits - (info_bits - 8))) #tables from this size on have 5 byte slots
+value_offset = 22 #scores are in [-21, 21]. stored as [1, 43] so that an empty slot is 0
+
+#replacement policies
+always_replace = 0 #newest entry always wins the slot
+depth_preferred = 1 #keep the entry closest to the root (fewest moves played), since it took the most work to compute
+replacement_policies = {'always': always_replace, 'depth': depth_preferred}
+
+#table files
+file_magic = b"C4TT"
+file_version = 2 #2: keys stored XORed with their info
+header_dtype = np.dtype([('magic', 'S4'), ('version', '<u4'), ('size', '<u8'), ('slot_bytes', '<u4')])
+header_bytes = 64 #slots start here. room for more header fields in later versions
+
+#results of table_store
+store_skipped = 0 #the replacement policy kept the old entry
+store_written = 1 #slot was empty or held the same position
+store_overwrote = 2 #slot held a different position, which is now lost
+
+
+def slot_dtype(size):
+    """ the slot layout of a table of 'size' slots: 5 bytes if the partial key of 25 bits is enough, 6 otherwise """
+    return small_slot_dtype if size >= min_small_slot_size else large_slot_dtype
+
+def key_bits(slot_type):
+    """ bits of the position key stored in a slot. the top bits of the info that don't fit in the info field go above them """
+    return word_bits - max(info_bits - 8 * slot_type['info'].itemsize, 0)
+
+
+""" bits of the info stored in a key field, below the partial key: 7 for 5 byte slots, 0 for 6 byte slots """
+@jit(nopython=True)
+def high_info_bits(infos):
+    return max(info_bits - 8 * infos.itemsize, 0)
+
+""" returns the packed info stored for 'key', or 0 if the key is not in the table """
+@jit(nopython=True)
+def table_lookup(keys, infos, key):
+    index = key % keys.shape[0]
+    low_info = np.int64(infos[index]) #read once each, a torn slot fails the check
+    if low_info == 0:
+        return 0
+    high_bits = high_info_bits(infos)
+    word = np.int64(keys[index]) ^ (low_info << high_bits)
+    if word >> high_bits != key & ((1 << (word_bits - high_bits)) - 1):
+        return 0
+    return low_info | ((word & ((1 << high_bits) - 1)) << (8 * infos.itemsize))
+
+@jit(nopython=True)
+def info_value(info):
+    return (info & 0x3f) - value_offset
+
+@jit(nopython=True)
+def info_move(info):
+    return (info >> 6) & 0x7
+
+@jit(nopython=True)
+def info_depth(info):
+    return (info >> 9) & 0x3f
+
+""" stores a score bound and best move for 'key', if the replacement policy allows it. returns one of the store_ results """
+@jit(nopython=True)
+def table_store(keys, infos, policy, key, value, move, n_moves):
+    index = key % keys.shape[0]
+    high_bits = high_info_bits(infos)
+    info_shift = 8 * infos.itemsize
+    partial_key = key & ((1 << (word_bits - high_bits)) - 1)
+    old_low_info = np.int64(infos[index])
+    old_word = np.int64(keys[index]) ^ (old_low_info << high_bits)
+    other_position = old_low_info != 0 and old_word >> high_bits != partial_key
+    if policy == depth_preferred and other_position:
+        old_info = old_low_info | ((old_word & ((1 << high_bits) - 1)) << info_shift)
+        if info_depth(old_info) < n_moves:
+            return store_skipped #slot holds a different position which is closer to the root. keep it
+    info = (value + value_offset) | (move << 6) | (n_moves << 9)
+    low_info = info & ((1 << info_shift) - 1)
+    keys[index] = ((partial_key << high_bits) | (info >> info_shift)) ^ (low_info << high_bits)
+    infos[index] = low_info
+    if other_position:
+        return store_overwrote
+    return store_written
+
+
+def modular_inverse(a, m):
+    """ returns x such that (a * x) % m == 1, using the extended Euclidean algorithm """
+    old_r, r = a % m, m
+    old_x, x = 1, 0
+    while r:
+        q = old_r // r
+        old_r, r = r, old_r - q * r
+        old_x, x = x, old_x - q * x
+    if old_r != 1:
+        raise ValueError("%d has no inverse modulo %d" % (a, m))
+    return old_x % m
+
+
+def read_table_header(file_name):
+    """ returns the number of slots of a table file. raises ValueError if the file is not a table file this version can read """
+    header = np.fromfile(file_name, dtype=header_dtype, count=1)
+    if len(header) == 0 or header['magic'][0] != file_magic:
+        raise ValueError("%s is not a transposition table file" % file_name)
+    if header['version'][0] != file_version:
+        raise ValueError("%s has table format version %d, expected %d" % (file_name, header['version'][0], file_version))
+    size = int(header['size'][0])
+    slot_bytes = slot_dtype(size).itemsize
+    if header['slot_bytes'][0] != slot_bytes:
+        raise ValueError("%s has %d byte slots, expected %d" % (file_name, header['slot_bytes'][0], slot_bytes))
+    if os.path.getsize(file_name) < header_bytes + size * slot_bytes:
+        raise ValueError("%s is truncated" % file_name)
+    return size
+
+def write_table_header(f, size):
+    header = np.zeros(1, dtype=header_dtype)
+    header['magic'] = file_magic
+    header['version'] = file_version
+    header['size'] = size
+    header['slot_bytes'] = slot_dtype(size).itemsize
+    f.write(header.tobytes().ljust(header_bytes, b"\0"))
+
+def create_table_file(file_name, size):
+    """ creates a table file of empty slots. the slots are not written, so the file stays sparse until the search fills it """
+    with open(file_name, 'wb') as f:
+        write_table_header(f, size)
+        f.truncate(header_bytes + size * slot_dtype(size).itemsize)
+
+
+class transposition_table:
+    """
+    Fixed size hash table of packed slots.
+    size: number of slots. Must be odd (coprime with 2^32) and at least 2^17 for the partial keys to be exact.
+        From 2^24 slots on, slots take 5 bytes instead of 6
+    policy: 'always' or 'depth'. Decides who keeps a slot when two positions map to the same index
+    file_name: optional table file. An existing file is opened with everything it holds, a missing one is created empty.
+        Either way the slots are memory-mapped from the file, and the file must have 'size' slots
+    read_only: map the file read-only, e.g. to merge it into another table
+    buffer: optional memory holding the slots instead, e.g. a multiprocessing.RawArray of size * slot_dtype(size).itemsize bytes
+        shared by several processes
+    """
+    def __init__(self, size=16777259, policy='always', file_name=None, read_only=False, buffer=None):
+        if size % 2 == 0 or size < min_table_size:
+            raise ValueError("table size must be odd and at least %d, got %d" % (min_table_size, size))
+        if policy not in replacement_policies:
+            raise ValueError("unknown replacement policy '%s', expected one of %s" % (policy, sorted(replacement_policies)))
+        self.size = size
+        self.policy_name = policy
+        self.policy = replacement_policies[policy]
+        self.file_name = file_name
+        self.slot_dtype = slot_dtype(size)
+        if buffer is not None:
+            self.slots = np.frombuffer(buffer, dtype=self.slot_dtype, count=size)
+        elif file_name is None:
+            self.slots = np.zeros(size, dtype=self.slot_dtype)
+        else:
+            if not os.path.exists(file_name):
+                create_table_file(file_name, size)
+            file_size = read_table_header(file_name)
+            if file_size != size:
+                raise ValueError("%s has %d slots, expected %d" % (file_name, file_size, size))
+            self.slots = np.memmap(file_name, dtype=self.slot_dtype, mode='r' if read_only else 'r+', offset=header_bytes, shape=(size,))
+        self.keys = self.slots['key'] #views into the packed slots, passed to the compiled search
+        self.infos = self.slots['info']
+
+    @classmethod
+    def open(cls, file_name, policy='always', read_only=False):
+        """ opens an existing table file, with the size found in its header """
+        return cls(read_table_header(file_name), policy, file_name, read_only)
+
+    def reset(self):
+        self.slots.fill(0)
+
+    def nbytes(self):
+        return self.slots.nbytes
+
+    def flush(self):
+        """ writes the stores of a file-backed table to disk. the OS does it anyway, this only forces it now """
+        if self.file_name is not None:
+            self.slots.flush()
+
+    def save(self, file_name):
+        """
+        writes a copy of the table to a table file. The copy goes to a temporary file which then replaces file_name,
+        so a process killed while saving leaves the old file intact
+        """
+        temp_name = file_name + ".tmp"
+        with open(temp_name, 'wb') as f:
+            write_table_header(f, self.size)
+            self.slots.tofile(f)
+        os.replace(temp_name, file_name)
+
+    def get(self, key):
+        """ returns (score bound, best move) stored for 'key', or None if the key is not in the table """
+        info = table_lookup(self.keys, self.infos, key)
+        if info == 0:
+            return None
+        return info_value(info), info_move(info)
+
+    def put(self, key, value, move, n_moves):
+        table_store(self.keys, self.infos, self.policy, key, value, move, n_moves)
+
+    def filled_slots(self):
+        """
+        returns (full keys, infos) of the filled slots, as uint64 and int32 arrays
+        The full key is rebuilt from the slot index and the partial key with the Chinese remainder theorem
+        """
+        index = np.nonzero(self.infos)[0].astype(np.int64)
+        partial_bits = key_bits(self.slot_dtype)
+        high_bits = word_bits - partial_bits
+        low_infos = self.infos[index].astype(np.int64)
+        words = self.keys[index].astype(np.int64) ^ (low_infos << high_bits)
+        partial_keys = words >> high_bits
+        infos = low_infos | ((words & ((1 << high_bits) - 1)) << (8 * self.infos.itemsize))
+        inverse = modular_inverse(1 << partial_bits, self.size)
+        high = ((index - partial_keys) % self.size) * inverse % self.size #key = partial_key + 2^partial_bits * high
+        full_keys = (partial_keys + (high << partial_bits)).astype(np.uint64)
+        return full_keys, infos.astype(np.int32)
+
+    def entries(self):
+        """ returns the filled slots as 3 arrays: full keys (uint64), values (int32) and moves (uint8) """
+        full_keys, infos = self.filled_slots()
+        values = (infos & 0x3f) - value_offset
+        moves = ((infos >> 6) & 0x7).astype(np.uint8)
+        return full_keys, values, moves
+
+
+def merge_tables(tables, merged):
+    """
+    Adds the entries of 'tables' to the table 'merged' (which may be file-backed, and may already hold entries).
+    A stored score is an upper bound, so when several tables have the same position the smallest bound is kept, with its move.
+    When different positions fall on the same slot of the merged table, the one closest to the root (fewest moves) is kept,
+    as with the 'depth' policy. The tables may have different sizes
+    """
+    all_keys, all_infos = zip(*[table.filled_slots() for table in [merged] + list(tables)])
+    keys = np.concatenate(all_keys)
+    infos = np.concatenate(all_infos)
+
+    order = np.lexsort((infos & 0x3f, keys)) #by key, smallest bound first. the stored value is the bound plus a constant
+    keys, infos = keys[order], infos[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    keys, infos = keys[first], infos[first]
+
+    index = (keys % np.uint64(merged.size)).astype(np.int64)
+    order = np.lexsort(((infos >> 9) & 0x3f, index)) #by slot, fewest moves first
+    index, keys, infos = index[order], keys[order], infos[order]
+    first = np.ones(len(index), dtype=bool)
+    first[1:] = index[1:] != index[:-1]
+
+    merged.reset()
+    keys, infos = keys[first].astype(np.int64), infos[first].astype(np.int64) #keys fit in 49 bits
+    high_bits = word_bits - key_bits(merged.slot_dtype)
+    info_shift = 8 * merged.infos.itemsize
+    low_infos = infos & ((1 << info_shift) - 1)
+    partial_keys = keys & ((1 << (word_bits - high_bits)) - 1)
+    merged.keys[index[first]] = ((partial_keys << high_bits) | (infos >> info_shift)) ^ (low_infos << high_bits) #as table_store writes them
+    merged.infos[index[first]] = low_infos
+    merged.flush()
+    return int(np.count_nonzero(first))
+
+def merge_table_files(out_file, in_files, size=None):
+    """ merges table files into out_file, with 'size' slots (default: the size of the largest input). returns the number of entries """
+    in_tables = [transposition_table.open(file_name, read_only=True) for file_name in in_files]
+    if size is None:
+        size = max(table.size for table in in_tables)
+    temp_name = out_file + ".tmp" #out_file may be one of the inputs. it is only replaced once the merge is done
+    if os.path.exists(temp_name):
+        os.remove(temp_name)
+    n_entries = merge_tables(in_tables, transposition_table(size, file_name=temp_name))
+    os.replace(temp_name, out_file)
+    return n_entries
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("usage: python solver_table.py out_file in_file1 in_file2 [...]")
+        sys.exit(1)
+    n_entries = merge_table_files(sys.argv[1], sys.argv[2:])
+    print("merged", n_entries, "entries into", sys.argv[1])